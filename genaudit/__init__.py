@@ -1 +1,7 @@
-from .factcheckers.base import FactChecker
\ No newline at end of file
+def __getattr__(name):
+    # FactChecker needs torch, so it is only imported when asked for. the serving modules which only need the standard
+    # library (e.g. the scheduler) can then be imported and tested without it.
+    if name=="FactChecker":
+        from .factcheckers.base import FactChecker
+        return FactChecker
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
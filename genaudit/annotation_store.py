@@ -0,0 +1,312 @@
+import argparse
+import fcntl
+import glob
+import gzip
+import json
+import os
+import threading
+import time
+
+CATALOG_NAME = "catalog.jsonl"
+SEGMENTS_DIR = "segments"
+LOCK_NAME = "lock"
+
+
+class AnnotationStore(object):
+    '''
+    Append-only store for saved examples, meant for directories on network storage where one small file per example
+    does not scale.
+
+    Records are appended to segment files (segments/segment-XXXXXX.jsonl.gz), each record as its own gzip member so
+    that a segment stays a valid .jsonl.gz file which any gzip reader can stream. A catalog file has one line per record
+    ([id, segment, offset, length, line]) so that a record can be read by its id without scanning the segments.
+
+    Writers take an exclusive lock on a lock file (POSIX locks, which also work on NFS) and re-read the tail of the
+    catalog before appending, so ids stay unique even with many server processes writing to the same store.
+    compact() rewrites the store into large segments (segments/compact-*.jsonl.gz) where many records share a gzip
+    member, which compresses much better; line then gives the position of a record inside its member.
+    '''
+    def __init__(self, path, max_segment_bytes=64*1024*1024):
+        self.path = path
+        self.max_segment_bytes = max_segment_bytes
+        os.makedirs(os.path.join(self.path, SEGMENTS_DIR), exist_ok=True)
+
+        self.catalog_path = os.path.join(self.path, CATALOG_NAME)
+        if not os.path.exists(self.catalog_path):
+            open(self.catalog_path, "a").close()
+
+        self.thread_lock = threading.Lock()
+        self.entries = {}   # id -> (segment, offset, length, line)
+        self.catalog_ino = None
+        self.catalog_offset = 0
+
+    @staticmethod
+    def is_store(path):
+        return os.path.exists(os.path.join(path, CATALOG_NAME))
+
+    def _file_lock(self):
+        return _FileLock(os.path.join(self.path, LOCK_NAME))
+
+    def _refresh_catalog(self):
+        # reads catalog lines added since the last call. if the catalog was replaced (by compaction), it is read from the start.
+        with open(self.catalog_path, "rb") as f:
+            ino = os.fstat(f.fileno()).st_ino
+            if ino!=self.catalog_ino:
+                self.entries = {}
+                self.catalog_offset = 0
+                self.catalog_ino = ino
+
+            f.seek(self.catalog_offset)
+            data = f.read()
+
+        # a line without a newline at the end is still being written by another process
+        complete = data[:data.rfind(b"\n")+1]
+        for line in complete.splitlines():
+            try:
+                _id, segment, offset, length, line_no = json.loads(line)
+            except ValueError:
+                # a damaged line (e.g. from a writer that crashed mid-write) must not make the rest of the store unreadable
+                continue
+            self.entries[_id] = (segment, offset, length, line_no)
+        self.catalog_offset += len(complete)
+
+    def _current_segment(self):
+        segments = sorted(os.listdir(os.path.join(self.path, SEGMENTS_DIR)))
+        segments = [x for x in segments if x.startswith("segment-")]
+        if len(segments)>0:
+            last = segments[-1]
+            if os.path.getsize(os.path.join(self.path, SEGMENTS_DIR, last))<self.max_segment_bytes:
+                return last
+            num = int(last[len("segment-"):].split(".")[0])+1
+        else:
+            num = 0
+        return f"segment-{num:06d}.jsonl.gz"
+
+    def append(self, record):
+        '''
+        Adds a record (a dict with an "id" field) to the store.
+        :return: False (without writing anything) if a record with the same id exists already, True otherwise.
+        '''
+        _id = record["id"]
+        line = (json.dumps(record, ensure_ascii=False)+"\n").encode("utf-8")
+        member = gzip.compress(line)
+
+        with self.thread_lock, self._file_lock():
+            self._refresh_catalog()
+            if _id in self.entries:
+                return False
+
+            # with the lock held, a line without a newline at the end of the catalog can only be left by a writer which
+            # crashed. it is cut off, otherwise the new line would get appended to it.
+            with open(self.catalog_path, "r+b") as f:
+                if f.seek(0, os.SEEK_END)>self.catalog_offset:
+                    f.truncate(self.catalog_offset)
+
+            segment = self._current_segment()
+            with open(os.path.join(self.path, SEGMENTS_DIR, segment), "ab") as f:
+                offset = f.seek(0, os.SEEK_END)
+                f.write(member)
+                f.flush()
+                os.fsync(f.fileno())
+
+            # the record only counts as stored once it is in the catalog. a crash before this leaves unreferenced bytes, which compaction drops.
+            with open(self.catalog_path, "ab") as f:
+                f.write((json.dumps([_id, segment, offset, len(member), 0], ensure_ascii=False)+"\n").encode("utf-8"))
+                f.flush()
+                os.fsync(f.fileno())
+
+            self._refresh_catalog()
+            return True
+
+    def ids(self):
+        with self.thread_lock:
+            self._refresh_catalog()
+            return list(self.entries.keys())
+
+    def __contains__(self, _id):
+        with self.thread_lock:
+            self._refresh_catalog()
+            return _id in self.entries
+
+    def _read_member(self, segment, offset, length):
+        with open(os.path.join(self.path, SEGMENTS_DIR, segment), "rb") as f:
+            f.seek(offset)
+            return gzip.decompress(f.read(length)).splitlines()
+
+    def get(self, _id):
+        with self.thread_lock:
+            self._refresh_catalog()
+            entry = self.entries.get(_id)
+        if entry is None:
+            raise KeyError(_id)
+
+        segment, offset, length, line_no = entry
+        try:
+            lines = self._read_member(segment, offset, length)
+        except FileNotFoundError:
+            # the segment was removed by a compaction in the meantime, so look the record up again in the new catalog
+            with self.thread_lock:
+                self.catalog_ino = None
+                self._refresh_catalog()
+                segment, offset, length, line_no = self.entries[_id]
+            lines = self._read_member(segment, offset, length)
+        return json.loads(lines[line_no])
+
+    def iter_records(self):
+        '''
+        Streams all records in the order they were stored, decompressing each gzip member only once.
+        '''
+        start_id = None
+        while True:
+            with self.thread_lock:
+                if start_id is not None:
+                    self.catalog_ino = None
+                self._refresh_catalog()
+                entries = sorted(self.entries.items(), key=lambda x: x[1])
+            if start_id is not None:
+                # compaction keeps the order of the records, so streaming goes on from the same record in the new catalog
+                entries = entries[[x[0] for x in entries].index(start_id):]
+
+            last_member = None
+            lines = None
+            for (_id, (segment, offset, length, line_no)) in entries:
+                if (segment, offset)!=last_member:
+                    try:
+                        lines = self._read_member(segment, offset, length)
+                    except FileNotFoundError:
+                        # the segment was removed by a compaction in the meantime
+                        start_id = _id
+                        break
+                    last_member = (segment, offset)
+                yield json.loads(lines[line_no])
+            else:
+                return
+
+    def compact(self, records_per_member=256):
+        '''
+        Rewrites the store so that many records share a gzip member and segments are as large as allowed. Readers
+        holding the old catalog notice that it got replaced and re-read it.
+        '''
+        with self.thread_lock, self._file_lock():
+            self._refresh_catalog()
+            entries = sorted(self.entries.items(), key=lambda x: x[1])
+            old_segments = set(os.listdir(os.path.join(self.path, SEGMENTS_DIR)))
+
+            # compacted segments sort before the ones appended later, so records keep their order
+            prefix = f"compact-{time.time_ns()}-"
+            new_catalog = []
+            segment_idx = 0
+            segment_file = None
+            last_member = None
+            lines = None
+
+            def flush_member(batch):
+                nonlocal segment_idx, segment_file
+                if segment_file is None or segment_file.tell()>=self.max_segment_bytes:
+                    if segment_file is not None:
+                        os.fsync(segment_file.fileno())
+                        segment_file.close()
+                        segment_idx += 1
+                    segment_file = open(os.path.join(self.path, SEGMENTS_DIR, f"{prefix}{segment_idx:06d}.jsonl.gz"), "wb")
+                member = gzip.compress(b"".join(x[1] for x in batch))
+                offset = segment_file.tell()
+                segment_file.write(member)
+                segment_name = os.path.basename(segment_file.name)
+                for (line_no, (_id, _)) in enumerate(batch):
+                    new_catalog.append([_id, segment_name, offset, len(member), line_no])
+
+            batch = []
+            for (_id, (segment, offset, length, line_no)) in entries:
+                if (segment, offset)!=last_member:
+                    lines = self._read_member(segment, offset, length)
+                    last_member = (segment, offset)
+                batch.append((_id, lines[line_no]+b"\n"))
+                if len(batch)>=records_per_member:
+                    flush_member(batch)
+                    batch = []
+            if len(batch)>0:
+                flush_member(batch)
+            if segment_file is not None:
+                segment_file.flush()
+                os.fsync(segment_file.fileno())
+                segment_file.close()
+
+            tmp_catalog_path = f"{self.catalog_path}.tmp"
+            with open(tmp_catalog_path, "wb") as f:
+                for entry in new_catalog:
+                    f.write((json.dumps(entry, ensure_ascii=False)+"\n").encode("utf-8"))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_catalog_path, self.catalog_path)
+
+            for segment in old_segments:
+                os.remove(os.path.join(self.path, SEGMENTS_DIR, segment))
+
+            self.catalog_ino = None
+            self._refresh_catalog()
+
+
+class _FileLock(object):
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        self.f = open(self.path, "a")
+        fcntl.lockf(self.f, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        fcntl.lockf(self.f, fcntl.LOCK_UN)
+        self.f.close()
+
+
+def iter_records(path):
+    '''
+    Streams all records stored in the store at the given path, e.g. for training or analysis jobs.
+    '''
+    return AnnotationStore(path).iter_records()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='tools for the append-only store of saved examples')
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = subparsers.add_parser("export", help="write all records of a store to a jsonl file (gzipped if the name ends with .gz)")
+    export_parser.add_argument("store", type=str)
+    export_parser.add_argument("output", type=str)
+
+    compact_parser = subparsers.add_parser("compact", help="rewrite a store into fewer, better compressed segments")
+    compact_parser.add_argument("store", type=str)
+    compact_parser.add_argument("--records-per-member", type=int, default=256)
+
+    import_parser = subparsers.add_parser("import", help="add the examples saved as separate json files in a directory to a store")
+    import_parser.add_argument("store", type=str)
+    import_parser.add_argument("json_dir", type=str)
+
+    args = parser.parse_args()
+    store = AnnotationStore(args.store)
+
+    if args.command=="export":
+        opener = gzip.open if args.output.endswith(".gz") else open
+        num = 0
+        with opener(args.output, "wt", encoding="utf-8") as w:
+            for record in store.iter_records():
+                w.write(json.dumps(record, ensure_ascii=False)+"\n")
+                num += 1
+        print(f"Exported {num} records to {args.output}")
+
+    elif args.command=="compact":
+        store.compact(records_per_member=args.records_per_member)
+        print(f"Compacted store with {len(store.ids())} records")
+
+    elif args.command=="import":
+        num_added = 0
+        num_skipped = 0
+        for fpath in sorted(glob.glob(f"{args.json_dir}/*.json")):
+            with open(fpath, encoding="utf-8") as f:
+                record = json.load(f)
+            if store.append(record):
+                num_added += 1
+            else:
+                num_skipped += 1
+        print(f"Imported {num_added} records ({num_skipped} skipped because their id exists already)")
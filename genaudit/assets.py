@@ -0,0 +1,133 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+
+from bottle import HTTPResponse, HTTPError
+
+try:
+    import brotli
+except ImportError:
+    # brotli is optional (pip install brotli). without it, assets are only served gzip-compressed.
+    brotli = None
+
+# only text-like files are worth compressing, images and fonts are compressed already
+COMPRESSIBLE_TYPES = ["text/", "application/javascript", "application/json", "image/svg+xml"]
+
+# file names carrying a version number (e.g. jquery-3.3.1.min.js), which change whenever the file does
+VERSIONED_NAME_PATTERN = r"-\d+(\.\d+)+(\.min)?\.(js|css)$"
+
+
+class _Asset(object):
+    def __init__(self, data, content_type, etag):
+        self.content_type = content_type
+        self.etag = etag
+        # encoding -> (body, etag). each encoding gets its own etag since the bytes differ.
+        self.variants = {"identity": (data, f'"{etag}"')}
+
+        if any(content_type.startswith(x) for x in COMPRESSIBLE_TYPES):
+            gzipped = gzip.compress(data, compresslevel=9, mtime=0)
+            if len(gzipped)<len(data):
+                self.variants["gzip"] = (gzipped, f'"{etag}-gzip"')
+            if brotli is not None:
+                brotlied = brotli.compress(data)
+                if len(brotlied)<len(data):
+                    self.variants["br"] = (brotlied, f'"{etag}-br"')
+
+
+class AssetCache(object):
+    '''
+    Holds the files of the web UI in memory, compressed once at startup, and serves them with content-hash ETags.
+
+    Files whose name carries their version (most of the vendored libraries, e.g. jquery-3.3.1.min.js) are cached by
+    browsers for a year without revalidation. Everything else (index.html, example.js, and vendored files without a
+    version in their name like codemirror.js) can change between releases, so browsers revalidate it on each load and
+    get a 304 when it has not changed.
+    '''
+    def __init__(self, root, immutable_pattern=VERSIONED_NAME_PATTERN):
+        self.root = root
+        self.immutable_pattern = re.compile(immutable_pattern)
+        self.assets = {}
+
+        for (dirpath, _, filenames) in os.walk(root):
+            for fname in filenames:
+                fpath = os.path.join(dirpath, fname)
+                relpath = os.path.relpath(fpath, root).replace(os.sep, "/")
+                with open(fpath, "rb") as f:
+                    data = f.read()
+                content_type, _ = mimetypes.guess_type(fname)
+                if content_type is None:
+                    content_type = "application/octet-stream"
+                if content_type.startswith("text/") or content_type=="application/javascript":
+                    content_type = f"{content_type}; charset=UTF-8"
+                etag = hashlib.sha256(data).hexdigest()[:20]
+                self.assets[relpath] = _Asset(data=data, content_type=content_type, etag=etag)
+
+    def get_cache_control(self, relpath):
+        if self.immutable_pattern.search(relpath) is not None:
+            return "public, max-age=31536000, immutable"
+        return "no-cache"
+
+    @staticmethod
+    def parse_accept_encoding(accept_encoding):
+        '''
+        :return: A dict from each encoding named in the Accept-Encoding header to its q-value (1 if not given).
+        '''
+        qvalues = {}
+        for part in accept_encoding.split(","):
+            fields = part.split(";")
+            encoding = fields[0].strip().lower()
+            if encoding=="":
+                continue
+            qvalue = 1.0
+            for param in fields[1:]:
+                name, _, value = param.partition("=")
+                if name.strip()=="q":
+                    try:
+                        qvalue = float(value)
+                    except ValueError:
+                        qvalue = 0.0
+            qvalues[encoding] = qvalue
+        return qvalues
+
+    @staticmethod
+    def pick_encoding(asset, accept_encoding):
+        # the compressed variant with the highest q-value, preferring br on ties. a q-value of 0 means not acceptable.
+        qvalues = AssetCache.parse_accept_encoding(accept_encoding)
+        best = None
+        for encoding in ["br", "gzip"]:
+            if encoding not in asset.variants:
+                continue
+            qvalue = qvalues.get(encoding, qvalues.get("*", 0.0))
+            if qvalue>0 and (best is None or qvalue>best[1]):
+                best = (encoding, qvalue)
+        return best[0] if best is not None else "identity"
+
+    def serve(self, relpath, request):
+        '''
+        :return: A bottle HTTPResponse with the file at relpath (relative to the root), or a 304 if the client has it already.
+        '''
+        asset = self.assets.get(relpath)
+        if asset is None:
+            raise HTTPError(404, "File does not exist.")
+
+        encoding = self.pick_encoding(asset, request.headers.get("Accept-Encoding", ""))
+        body, etag = asset.variants[encoding]
+
+        headers = {
+            "ETag": etag,
+            "Cache-Control": self.get_cache_control(relpath),
+            "Vary": "Accept-Encoding",
+        }
+
+        if_none_match = request.headers.get("If-None-Match", "")
+        known_etags = set(x[1] for x in asset.variants.values())
+        if any(x.strip() in known_etags for x in if_none_match.split(",")):
+            return HTTPResponse(status=304, **headers)
+
+        headers["Content-Type"] = asset.content_type
+        headers["Content-Length"] = str(len(body))
+        if encoding!="identity":
+            headers["Content-Encoding"] = encoding
+        return HTTPResponse(body=body, status=200, **headers)
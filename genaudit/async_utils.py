@@ -0,0 +1,29 @@
+import asyncio
+
+
+def make_semaphore(loop, value):
+    '''
+    Creates the semaphore on the given loop, since asyncio primitives bind to the loop that is current when they get
+    created (on python 3.9).
+    '''
+    async def create():
+        return asyncio.Semaphore(value)
+    return loop.run_until_complete(create())
+
+
+async def run_cancellable(coro, should_stop):
+    '''
+    Runs coro, checking should_stop every 50ms and cancelling it once that returns True. Cancelling closes the requests
+    in flight, which makes the server stop generating for them too.
+    :return: The result of coro, or None if it got cancelled.
+    '''
+    task = asyncio.ensure_future(coro)
+    while not task.done():
+        if should_stop is not None and should_stop():
+            task.cancel()
+            break
+        await asyncio.wait([task], timeout=0.05)
+    try:
+        return await task
+    except asyncio.CancelledError:
+        return None
@@ -0,0 +1,93 @@
+import json
+import os
+import sqlite3
+import threading
+
+
+def make_factcheck_payload(reference_sents, claim, prev_sents, evidence_only=False):
+    return {
+        "reference_sents": reference_sents,
+        "claim": claim,
+        "prev_sents": prev_sents,
+        # only find the evidence (e.g. for linking citations), skipping the much longer revision
+        "evidence_only": evidence_only,
+    }
+
+
+def get_example_payloads(example):
+    '''
+    The fact-checking requests that the web UI makes when it opens an example: one for each non-empty line of the
+    output, with the lines before it as context.
+    :param example: An example as returned by /get_example (with stripped lines).
+    :return: A list aligned with the output lines, holding None for empty lines.
+    '''
+    payloads = []
+    for (j, claim) in enumerate(example["output_lines"]):
+        if claim.strip()=="":
+            payloads.append(None)
+        else:
+            payloads.append(make_factcheck_payload(example["input_lines"], claim, example["output_lines"][:j]))
+    return payloads
+
+
+class AuditCache(object):
+    '''
+    Keeps fact-checking results computed ahead of time for the sentences of stored examples, so that opening an example
+    does not have to wait for the model.
+
+    Results are stored in SQLite under the fingerprint of the request (see scheduler.get_fingerprint). They are only
+    valid for the model and decoding parameters they were computed with, so each model fingerprint gets its own file in
+    cache_dir. Servers with different models can then share the directory without touching each other's results, and
+    changing the model or its parameters starts from an empty cache. Files of models no longer in use can be deleted.
+    '''
+    def __init__(self, cache_dir, model_fingerprint):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, f"audits-{model_fingerprint[:16]}.sqlite")
+        self.lock = threading.Lock()
+        self.num_hits = 0
+        self.num_misses = 0
+
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS audits (fingerprint TEXT PRIMARY KEY, result TEXT)")
+            # examples all of whose sentences are in the cache, with the version (see ExampleGetter.get_versions) that was audited
+            self.db.execute("CREATE TABLE IF NOT EXISTS examples (id TEXT PRIMARY KEY, version TEXT)")
+
+    def get(self, fingerprint, count=True):
+        '''
+        :param count: Whether the lookup counts towards the hit rate (lookups by the pre-auditor itself should not).
+        :return: The cached result, or None.
+        '''
+        with self.lock:
+            row = self.db.execute("SELECT result FROM audits WHERE fingerprint=?", (fingerprint,)).fetchone()
+            if count:
+                if row is None:
+                    self.num_misses += 1
+                else:
+                    self.num_hits += 1
+        return json.loads(row[0]) if row is not None else None
+
+    def put(self, fingerprint, result):
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO audits (fingerprint, result) VALUES (?, ?)",
+                            (fingerprint, json.dumps(result, ensure_ascii=False)))
+
+    def get_audited_examples(self):
+        '''
+        :return: A dict from the id of each fully audited example to its version at the time.
+        '''
+        with self.lock:
+            return dict(self.db.execute("SELECT id, version FROM examples").fetchall())
+
+    def mark_audited(self, example_id, version):
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO examples (id, version) VALUES (?, ?)", (example_id, version))
+
+    def get_stats(self):
+        with self.lock:
+            num_entries = self.db.execute("SELECT COUNT(*) FROM audits").fetchone()[0]
+            num_lookups = self.num_hits+self.num_misses
+            return {"entries": num_entries,
+                    "hits": self.num_hits,
+                    "misses": self.num_misses,
+                    "hit_rate": self.num_hits/num_lookups if num_lookups>0 else 0.0}
@@ -0,0 +1,97 @@
+import argparse
+import glob
+import json
+import os
+import time
+
+from .factcheckers import FactChecker
+from .stats import LatencyStats
+
+samples_path = f"{os.path.dirname(__file__)}/examples/saved"
+
+
+def get_requests(num_requests):
+    '''
+    Fact-checking requests made from the sentences of the bundled examples, each one with the sentences before it as context.
+    '''
+    requests = []
+    for fpath in sorted(glob.glob(f"{samples_path}/*.json")):
+        with open(fpath, encoding="utf-8") as f:
+            example = json.load(f)
+        for (j, claim) in enumerate(example["output_lines"]):
+            requests.append({"reference_sents": example["input_lines"],
+                             "claim": claim,
+                             "prev_sents": example["output_lines"][:j]})
+    return (requests*(num_requests//len(requests)+1))[:num_requests]
+
+
+def run_benchmark(fc, requests):
+    '''
+    :return: A tuple of the outputs, and the latency of the first request with a summary of the latencies of the ones after it (the steady state).
+    '''
+    steady_stats = LatencyStats()
+    first_secs = None
+    outputs = []
+    for (j, req) in enumerate(requests):
+        start_time = time.time()
+        outputs.append(fc.predict(**req))
+        elapsed = time.time()-start_time
+        if j==0:
+            first_secs = elapsed
+        else:
+            steady_stats.add(elapsed)
+    return outputs, {"first_request_secs": first_secs, "steady_state_secs": steady_stats.summary()}
+
+
+def get_agreement(outputs, reference_outputs):
+    # fraction of sentences for which two models gave the same evidence and the same edits
+    same = [x["success"]==y["success"] and x["result"]==y["result"] for (x, y) in zip(outputs, reference_outputs)]
+    return sum(same)/len(same)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='measure the latency of the first fact-checking request against the steady state, e.g. to compare the effect of --warmup and --compile, or different backends for the same model')
+
+    parser.add_argument("--factcheck-model", type=str, nargs="+", required=True, help="model(s) to use for fact-checking claims. when several are given (e.g. hf:<model> onnx:<exported dir>), they are run one after the other and their outputs compared with those of the first one.")
+    parser.add_argument("--device", type=str, default="cpu", choices=["cuda", "cpu"], help="device to run the model on (only for hf models)")
+    parser.add_argument("--dtype", type=str, default="float32", choices=["float32", "bfloat16"], help="dtype of the model when running on cpu")
+    parser.add_argument("--num-threads", type=int, default=None, help="number of threads used by torch on cpu (all cores by default)")
+    parser.add_argument("--nbeams", type=int, default=4, help="number of beams to use while decoding")
+    parser.add_argument("--max-decode-len", type=int, default=250, help="maximum output length of the model")
+    parser.add_argument("--compile", action="store_true", help="compile the model with torch.compile")
+    parser.add_argument("--warmup", action="store_true", help="run the warmup done by the server at startup before measuring")
+    parser.add_argument("--num-requests", type=int, default=20, help="number of requests to measure, including the first one")
+
+    args = parser.parse_args()
+
+    model_args = {"nbeams": args.nbeams, "max_decode_len": args.max_decode_len}
+    if args.device=="cpu":
+        model_args.update({"device": "cpu", "dtype": args.dtype, "num_threads": args.num_threads})
+    if args.compile:
+        model_args["use_compile"] = True
+
+    requests = get_requests(args.num_requests)
+    all_results = []
+    reference_outputs = None
+    for factcheck_model in args.factcheck_model:
+        results = {"factcheck_model": factcheck_model, "device": args.device, "compile": args.compile, "warmup": args.warmup}
+
+        start_time = time.time()
+        fc = FactChecker(factcheck_model, **model_args)
+        results["load_secs"] = time.time()-start_time
+
+        if args.warmup:
+            start_time = time.time()
+            fc.warmup()
+            results["warmup_secs"] = time.time()-start_time
+
+        outputs, latencies = run_benchmark(fc, requests)
+        results.update(latencies)
+        if reference_outputs is None:
+            reference_outputs = outputs
+        else:
+            results["agreement_with_first"] = get_agreement(outputs, reference_outputs)
+        all_results.append(results)
+        del fc
+
+    print(json.dumps(all_results, indent=2))
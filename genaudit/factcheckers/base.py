@@ -1,20 +1,39 @@
+import json
+import os
 from .utils import get_shift
 from .hf_predictor import HFPredictor
+from .oai_predictor import OpenaiCompatPredictor
+from .stub_predictor import StubPredictor
+from .onnx_predictor import OnnxPredictor
+from ..stats import CascadeStats
 import spacy
 
+# a real document and summary, so that warmup runs prompts like the ones seen in use
+WARMUP_EXAMPLE_PATH = os.path.join(os.path.dirname(__file__), "..", "examples", "saved", "Ex1_discharge_summary.json")
+
 class FactChecker(object):
-    def __init__(self, model_name, allow_additions=False, **kwargs):
+    def __init__(self, model_name, allow_additions=False, cascade_threshold=0.8, **kwargs):
+        '''
+        :param model_name: The model as <protocol>:<name>, e.g. hf:kundank/genaudit-usb-flanul2. Several models can be given separated by commas to form a cascade (see predict_many), e.g. hf:<small model>,hf:<large model>. A tier can override the number of beams with @nbeams=<n> (hf models only), so that e.g. hf:<model>@nbeams=1,hf:<model> first decodes greedily and then with beam search. Tiers using the same model share one copy of it.
+        :param cascade_threshold: Outputs of a tier (except the last one) with a confidence below this go to the next tier.
+        :param kwargs: Passed on to the model of every tier.
+        '''
         self.allow_additions=allow_additions
+        self.cascade_threshold = cascade_threshold
 
-        parts = model_name.split(":")
-        protocol = parts[0]
-        model_name = ":".join(parts[1:])
+        self.tiers = []     # (model, overrides of predict arguments)
+        loaded = {}
+        for tier_name in model_name.split(","):
+            tier_model_name, overrides = self.parse_tier(tier_name.strip())
+            if tier_model_name not in loaded:
+                loaded[tier_model_name] = self.load_model(tier_model_name, **kwargs)
+            if len(overrides)>0 and not tier_model_name.startswith("hf:"):
+                print("Overriding the number of beams is only supported for hf models")
+                raise NotImplementedError
+            self.tiers.append((loaded[tier_model_name], overrides))
 
-        if protocol=="hf":
-            self.model = HFPredictor(model_name=model_name, **kwargs)
-        else:
-            print("Unrecognized protocol passed for factchecking model. Currently supported protocols are: hf(huggingface)")
-            raise NotImplementedError
+        self.model = self.tiers[-1][0]
+        self.cascade_stats = CascadeStats([x.strip() for x in model_name.split(",")])
 
         try:
             self.nlp = spacy.load("en_core_web_md")
@@ -24,17 +43,76 @@ class FactChecker(object):
             download("en_core_web_md")
             self.nlp = spacy.load("en_core_web_md")
 
+    @staticmethod
+    def parse_tier(tier_name):
+        overrides = {}
+        if "@" in tier_name:
+            tier_name, options = tier_name.split("@")
+            for option in options.split(";"):
+                key, value = option.split("=")
+                if key!="nbeams":
+                    print(f"Unrecognized option for a fact-checking model: {key}")
+                    raise NotImplementedError
+                overrides[key] = int(value)
+        return tier_name, overrides
+
+    @staticmethod
+    def load_model(model_name, **kwargs):
+        parts = model_name.split(":")
+        protocol = parts[0]
+        model_name = ":".join(parts[1:])
+
+        if protocol=="hf":
+            return HFPredictor(model_name=model_name, **kwargs)
+        elif protocol=="oai":
+            return OpenaiCompatPredictor(model_name=model_name, **kwargs)
+        elif protocol in ["http", "https"]:
+            # the model name is the url of an OpenAI-compatible server, e.g. http://localhost:8000/v1
+            return OpenaiCompatPredictor(model_name=f"{protocol}:{model_name}", **kwargs)
+        elif protocol=="onnx":
+            # the model name is a directory with a model exported by onnx_predictor.py
+            return OnnxPredictor(model_name=model_name, **kwargs)
+        elif protocol=="stub":
+            # no model, for load tests (e.g. stub:0.2 takes 0.2s per sentence)
+            return StubPredictor(model_name=model_name, **kwargs)
+        else:
+            print("Unrecognized protocol passed for factchecking model. Currently supported protocols are: hf(huggingface), onnx(exported to ONNX), oai/http/https(OpenAI-compatible server), stub(no model, for testing)")
+            raise NotImplementedError
+
+    def warmup(self, ref_lengths=(8, 24, 64)):
+        '''
+        Runs every tier once on prompts with reference documents of the given numbers of sentences, so that the first
+        requests do not pay for the lazy initialization of kernels, memory pools and tokenizer caches (and, for compiled
+        models, the compilation of each padded input length).
+        '''
+        with open(WARMUP_EXAMPLE_PATH, encoding="utf-8") as f:
+            example = json.load(f)
+        input_lines = example["input_lines"]
+
+        for num_sents in ref_lengths:
+            reference_sents = (input_lines*(num_sents//len(input_lines)+1))[:num_sents]
+            dp = self.make_dp(reference_sents, example["output_lines"][0], [])
+            for tier in range(len(self.tiers)):
+                self.run_tier(tier, [dp], should_stop=None, evidence_only=False, with_confidence=tier<len(self.tiers)-1)
+
+    def get_stats(self):
+        '''
+        :return: For each tier of the cascade, how many sentences reached it, how many it settled (hit_rate is their ratio), and why the others were passed on (low_confidence or parse_failure).
+        '''
+        return self.cascade_stats.summary()
+
     def sent_tokenize(self, s):
         s = s.replace("\n", " ").strip()
         doc = self.nlp(s)
         sents = [str(s) for s in doc.sents]
         return sents
 
-    def check(self, reference, claim):
+    def check(self, reference, claim, evidence_only=False):
         '''
         Function to factcheck claim against reference document.
         :param reference: Text from the reference document. Could be a string or a list containing its sentences in sequence.
         :param claim: The claim to be fact-checked. Could be a string or a list representing its sentence-tokenized form.
+        :param evidence_only: Only find the evidence for each sentence, without revising it. Decoding stops after the evidence, so this is much faster. The edit fields are then empty and fixed_txt is the sentence itself.
         :return: A dictionary containing:
             1. reference_sents: List of sentences in the reference
             2. claim_sents: A list containing an object for each sentence in the claim, where the object contains the following fields:
@@ -61,8 +139,8 @@ class FactChecker(object):
 
 
         results = {"reference_sents": reference_sents, "claim_sents":[]}
-        for (j, claimsent) in enumerate(claim_sents):
-            output = self.predict(reference_sents, claimsent, claim_sents[:j])
+        outputs = self.predict_many(reference_sents, claim_sents, evidence_only=evidence_only)
+        for (claimsent, output) in zip(claim_sents, outputs):
             if not output["success"]:
                 results["claim_sents"].append({"txt":claimsent, "success":False})
             else:
@@ -87,57 +165,145 @@ class FactChecker(object):
         return results
 
 
-    def predict(self, reference_sents, claim, prev_sents=None):
-        if prev_sents is None:
-            prev_sents = []
-
-        # the whitespaces are stripped before feeding into the model. The offset needs to be compensated later when returning the spans to delete.
-        num_frontspaces = len(claim)-len(claim.lstrip())
-        claim = claim.strip()
-
-        dp = {
+    def make_dp(self, reference_sents, claim, prev_sents):
+        # the whitespaces are stripped before feeding into the model. The offset is compensated in parse_output when returning the spans to delete.
+        return {
           'input_lines': reference_sents,
-          'before_summary_sent': claim,
+          'before_summary_sent': claim.strip(),
           'prev_summ_lines': prev_sents,
           'after_summary_sent': "dummmy",
           'id': 'xxxxx',
           'evidence_labels': [0]
         }
 
-        try:
-            output = self.model.predict(dp)
+    def parse_output(self, output, claim, evidence_only=False):
+        '''
+        Turns the raw output of the model ("EVIDENCE: SENTi SENTj ... REVISION: <revised claim>") into evidence labels and
+        edits to the claim. Raises an exception if the output is badly formatted.
+        With evidence_only, the output may end anywhere after the evidence, and no edits are returned.
+        '''
+        num_frontspaces = len(claim)-len(claim.lstrip())
+        claim = claim.strip()
 
-            fixed_output = output.split("REVISION:")[1].strip()
-            ev_sentids = output.split("REVISION:")[0].split("EVIDENCE: ")[1].strip()
+        ev_sentids = output.split("REVISION:")[0].split("EVIDENCE:")[1].strip()
 
-            ev_labels = []
-            for one_sentid in ev_sentids.split(" "):
-                this_idx = one_sentid.split("SENT")[-1]
-                try:
-                    ev_labels.append(int(this_idx))
-                except:
-                    # this will happen if no evidence was predicted or if the outputs were badly formatted
-                    continue
+        ev_labels = []
+        for one_sentid in ev_sentids.split(" "):
+            this_idx = one_sentid.split("SENT")[-1]
+            try:
+                ev_labels.append(int(this_idx))
+            except:
+                # this will happen if no evidence was predicted or if the outputs were badly formatted
+                continue
 
-            diff = get_shift(summary_line=claim, fixed_output=fixed_output, allow_additions=self.allow_additions)
+        if evidence_only:
+            return {"evidence_labels": ev_labels,
+                    "todelete_spans": [],
+                    "replacement_strings": []}
 
-            result = {"evidence_labels": ev_labels,
-                      "todelete_spans": diff["todelete_spans"],
-                      "replacement_strings": diff["replacement_strings"]}
+        fixed_output = output.split("REVISION:")[1].strip()
+        diff = get_shift(summary_line=claim, fixed_output=fixed_output, allow_additions=self.allow_additions)
 
-            # adjust for the spaces at the beginning
-            todelete_spans = result["todelete_spans"]
-            for j in range(len(todelete_spans)):
-                todelete_spans[j][0] += num_frontspaces
-                todelete_spans[j][1] += num_frontspaces
+        result = {"evidence_labels": ev_labels,
+                  "todelete_spans": diff["todelete_spans"],
+                  "replacement_strings": diff["replacement_strings"]}
 
+        # adjust for the spaces at the beginning
+        todelete_spans = result["todelete_spans"]
+        for j in range(len(todelete_spans)):
+            todelete_spans[j][0] += num_frontspaces
+            todelete_spans[j][1] += num_frontspaces
 
-            return {"result": result, "success":True}
+        return result
 
-        except:
-            # need to always return something in case there is an error. else threads waiting for it in the frontend code will stall forever
-            result = {"evidence_labels": [],
-                    "todelete_spans": [],
-                    "replacement_strings": []}
-            return {"result":result, "success":False}
+    def failed_output(self, cancelled=False):
+        # need to always return something in case there is an error. else threads waiting for it in the frontend code will stall forever
+        result = {"evidence_labels": [],
+                "todelete_spans": [],
+                "replacement_strings": []}
+        output = {"result":result, "success":False}
+        if cancelled:
+            output["cancelled"] = True
+        return output
+
+    def predict(self, reference_sents, claim, prev_sents=None, should_stop=None, evidence_only=False):
+        '''
+        Fact-checks a single claim sentence. If should_stop is given, it is polled during generation and the prediction
+        is abandoned (returned with success=False and cancelled=True) once it returns True.
+        With evidence_only, generation stops after the evidence and the claim is not revised (see check).
+        '''
+        if prev_sents is None:
+            prev_sents = []
 
+        dp = self.make_dp(reference_sents, claim, prev_sents)
+        return self.run_cascade([dp], [claim], should_stop=should_stop, evidence_only=evidence_only)[0]
+
+    def predict_many(self, reference_sents, claims, should_stop=None, evidence_only=False):
+        '''
+        Fact-checks all sentences of a claim, each one with the sentences before it as context. Models which can run many
+        requests at once (e.g. behind an inference server) get all sentences in one go, others get them one by one.
+        '''
+        dps = [self.make_dp(reference_sents, claim, claims[:j]) for (j, claim) in enumerate(claims)]
+        return self.run_cascade(dps, claims, should_stop=should_stop, evidence_only=evidence_only)
+
+    def run_tier(self, tier, dps, should_stop, evidence_only, with_confidence):
+        # returns the raw outputs (or (output, confidence) tuples), with None or an exception in place of failed ones
+        model, overrides = self.tiers[tier]
+        if hasattr(model, "predict_many"):
+            return model.predict_many(dps, should_stop=should_stop, evidence_only=evidence_only, with_confidence=with_confidence, **overrides)
+
+        outputs = []
+        for dp in dps:
+            try:
+                outputs.append(model.predict(dp, should_stop=should_stop, evidence_only=evidence_only, with_confidence=with_confidence, **overrides))
+            except Exception as e:
+                outputs.append(e)
+        return outputs
+
+    def run_cascade(self, dps, claims, should_stop=None, evidence_only=False):
+        '''
+        Runs the tiers in order. Each tier gets the sentences which the tiers before it could not settle: the ones whose
+        output could not be parsed, or (for all but the last tier) whose confidence is below cascade_threshold. With a
+        single tier, this is a plain prediction.
+        Each output records the tier that produced it (tier) and why the tiers before it passed it on (escalations).
+        '''
+        results = [None]*len(dps)
+        escalations = [[] for _ in dps]
+        pending = list(range(len(dps)))
+
+        for tier in range(len(self.tiers)):
+            is_last = tier==len(self.tiers)-1
+            outputs = self.run_tier(tier, [dps[i] for i in pending], should_stop, evidence_only, with_confidence=not is_last)
+
+            still_pending = []
+            for (i, output) in zip(pending, outputs):
+                if should_stop is not None and should_stop():
+                    results[i] = self.failed_output(cancelled=True)
+                    continue
+
+                try:
+                    if not is_last:
+                        output, confidence = output
+                    result = {"result": self.parse_output(output, claims[i], evidence_only=evidence_only), "success": True}
+                except:
+                    result = None
+
+                if result is None and not is_last:
+                    escalations[i].append("parse_failure")
+                    still_pending.append(i)
+                elif result is not None and not is_last and confidence<self.cascade_threshold:
+                    escalations[i].append("low_confidence")
+                    still_pending.append(i)
+                else:
+                    if result is None:
+                        result = self.failed_output()
+                    result["tier"] = tier
+                    result["escalations"] = escalations[i]
+                    self.cascade_stats.add(result)
+                    results[i] = result
+
+            pending = still_pending
+            if len(pending)==0:
+                break
+
+        return results
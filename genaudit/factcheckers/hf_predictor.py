@@ -1,23 +1,88 @@
+import hashlib
+import math
+import os
 from transformers import AutoTokenizer, AutoModelForSeq2SeqLM, AutoConfig, AutoModelForCausalLM
 import torch.nn.functional
-from transformers import BitsAndBytesConfig
+from accelerate import init_empty_weights
+from transformers import BitsAndBytesConfig, StoppingCriteriaList
 from peft import PeftModel
 from peft import PeftConfig
+from huggingface_hub import snapshot_download
+from ..stopping import CancelCriteria, StopStringCriteria
+from .utils import make_prompt
+
+
+CPU_DTYPES = {"float32": torch.float32, "bfloat16": torch.bfloat16}
+
+
+def get_model_cls(config):
+    if config.is_encoder_decoder:
+        return AutoModelForSeq2SeqLM
+    else:
+        return AutoModelForCausalLM
+
+
+def load_merged_model(model_name, dtype="float32"):
+    '''
+    Loads the base model on CPU without quantization and merges the PEFT adapter into its weights, so that generation
+    runs on plain linear layers.
+    '''
+    adapter_config = PeftConfig.from_pretrained(model_name)
+    base_model_name_or_path = adapter_config.base_model_name_or_path
+    config = AutoConfig.from_pretrained(base_model_name_or_path)
+
+    model = get_model_cls(config).from_pretrained(base_model_name_or_path, torch_dtype=CPU_DTYPES[dtype])
+    model = PeftModel.from_pretrained(model, model_name, torch_dtype=CPU_DTYPES[dtype])
+    return model.merge_and_unload()
+
+
+def get_adapter_hash(model_name):
+    '''
+    :param model_name: A local directory or a repo on the hub (whose latest revision is fetched, like PeftModel.from_pretrained does).
+    :return: A hash of the adapter's files, which changes whenever the adapter (or the base model named in its config) does.
+    '''
+    adapter_dir = model_name if os.path.isdir(model_name) else snapshot_download(model_name, allow_patterns=["adapter_*"])
+    h = hashlib.sha256()
+    for fname in sorted(os.listdir(adapter_dir)):
+        if fname.startswith("adapter_"):
+            h.update(fname.encode("utf-8"))
+            with open(os.path.join(adapter_dir, fname), "rb") as f:
+                for block in iter(lambda: f.read(1<<20), b""):
+                    h.update(block)
+    return h.hexdigest()[:16]
+
+
+def prepare_merged_weights(model_name, cache_dir, dtype="float32"):
+    '''
+    Merges the adapter into the base model once and saves the result as a single checkpoint, which CPU workers then
+    memory-map (see HFPredictor) instead of each loading and merging the model on its own.
+    :return: Path of the checkpoint. It is reused as long as the adapter does not change.
+    '''
+    os.makedirs(cache_dir, exist_ok=True)
+    # keyed by the adapter's contents, so that a new revision of the adapter is not served from a stale checkpoint
+    path = os.path.join(cache_dir, f"{model_name.strip('/').replace('/', '--')}-{get_adapter_hash(model_name)}-{dtype}-merged.pt")
+    if os.path.exists(path):
+        return path
+
+    model = load_merged_model(model_name, dtype=dtype)
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    torch.save(model.state_dict(), tmp_path)
+    os.replace(tmp_path, path)
+    return path
 
 
 class HFPredictor(object):
-    def __init__(self, model_name, gpu_idx=0, nbeams=4, max_decode_len=999):
-
+    def __init__(self, model_name, gpu_idx=0, nbeams=4, max_decode_len=999, device="cuda", dtype="float32", merged_weights_path=None, num_threads=None,
+                 use_compile=False, min_bucket_len=64):
+        '''
+        :param device: "cuda" loads the model 4-bit quantized on the GPU gpu_idx. "cpu" loads it unquantized in the given dtype with the adapter merged.
+        :param merged_weights_path: Only for device "cpu". A checkpoint written by prepare_merged_weights, which is memory-mapped rather than read into memory. Processes mapping the same file share its pages, so running many workers costs little extra memory.
+        :param num_threads: Only for device "cpu". Number of threads torch uses in this process, so that several workers do not oversubscribe the cores.
+        :param use_compile: Compile the model with torch.compile. Prompts are then padded to a power of two (at least min_bucket_len tokens), so that only a few input shapes get compiled. The first prompt of each length bucket is slow, so use this together with a warmup (see FactChecker.warmup).
+        '''
         adapter_config = PeftConfig.from_pretrained(model_name)
         base_model_name_or_path = adapter_config.base_model_name_or_path
 
-        bnb_config = BitsAndBytesConfig(
-            load_in_4bit=True,
-            bnb_4bit_use_double_quant=True,
-            bnb_4bit_quant_type="nf4",
-            bnb_4bit_compute_dtype=torch.bfloat16
-        )
-
         tokenizer = AutoTokenizer.from_pretrained(
             base_model_name_or_path,
             use_fast=False
@@ -26,6 +91,42 @@ class HFPredictor(object):
         if tokenizer.pad_token==None:
             tokenizer.pad_token = tokenizer.eos_token
 
+        self.tokenizer = tokenizer
+        self.max_decode_len = max_decode_len
+        self.nbeams = nbeams
+        self.use_compile = use_compile
+        self.min_bucket_len = min_bucket_len
+
+        if device=="cpu":
+            if num_threads is not None:
+                torch.set_num_threads(num_threads)
+
+            if merged_weights_path is not None:
+                config = AutoConfig.from_pretrained(base_model_name_or_path)
+                # parameters are created on the meta device (no memory), and then pointed at the tensors of the mapped file
+                with init_empty_weights(include_buffers=False):
+                    model = get_model_cls(config).from_config(config, torch_dtype=CPU_DTYPES[dtype])
+                state_dict = torch.load(merged_weights_path, map_location="cpu", mmap=True, weights_only=True)
+                model.load_state_dict(state_dict, assign=True)
+                model.tie_weights()
+            else:
+                model = load_merged_model(model_name, dtype=dtype)
+
+            model.requires_grad_(False)
+            model.eval()
+            model.config.use_cache=True
+            self.model = model
+            self.is_encoder_decoder = model.config.is_encoder_decoder
+            if use_compile:
+                self.compile_model()
+            return
+
+        bnb_config = BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_use_double_quant=True,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_compute_dtype=torch.bfloat16
+        )
 
         is_encoder_decoder = False
         config = AutoConfig.from_pretrained(base_model_name_or_path)
@@ -54,59 +155,69 @@ class HFPredictor(object):
 
         self.model = mdl2
         self.is_encoder_decoder = model.config.is_encoder_decoder
-        self.tokenizer = tokenizer
-        self.max_decode_len = max_decode_len
-        self.nbeams = nbeams
-
-
-    def preprocess(self, dp):
-        PROMPT_STR = "You are provided a document and its summary. The summary may potentially contain factual errors. The last sentence of the summary is marked as a claim. Find all sentences in the document providing evidence for the claim, and then revise the claim to remove or replace unsupported facts."
-        input_string = f"{PROMPT_STR} DOCUMENT:"
-        for _i,sent in enumerate(dp["input_lines"]):
-            input_string = f"{input_string} SENT{_i} {sent}"
-
-        input_string = f"{input_string} SUMMARY:"
-        for _k, sent in enumerate(dp["prev_summ_lines"]):
-            input_string = f"{input_string} {sent}"
-
-        input_string = f"{input_string} CLAIM: {dp['before_summary_sent']}"
-        output_string = ""
+        if use_compile:
+            self.compile_model()
 
+    def compile_model(self):
+        # generate() calls the underlying transformers model, not the peft wrapper
+        model = self.model.get_base_model() if hasattr(self.model, "get_base_model") else self.model
         if self.is_encoder_decoder:
-            output_string = f"EVIDENCE:"
-        else:
-            input_string = f"{input_string} EVIDENCE:"
-
-        for ev_idx in dp["evidence_labels"]:
-            output_string = f"{output_string} SENT{ev_idx}"
-        output_string = f"{output_string} REVISION: {dp['after_summary_sent']}"
-
-        input_string = input_string.strip()
-        output_string = output_string.strip()
-
-        dp["input_string"] = input_string
-        dp["output_string"] = output_string
+            # the encoder only ever sees prompts padded to a bucket length, so it can be compiled for static shapes
+            encoder = model.get_encoder()
+            encoder.forward = torch.compile(encoder.forward, dynamic=False)
+        # the decoder sees a longer cache at every step, so it is compiled for dynamic shapes
+        model.forward = torch.compile(model.forward, dynamic=True)
+
+    def get_bucket_len(self, length):
+        return max(self.min_bucket_len, 2**math.ceil(math.log2(length)))
+
+    def pad_to_bucket(self, input_ids):
+        length = input_ids.shape[-1]
+        num_pad = self.get_bucket_len(length)-length
+        padding = torch.full((input_ids.shape[0], num_pad), self.tokenizer.pad_token_id, dtype=input_ids.dtype, device=input_ids.device)
+        attention_mask = torch.ones_like(input_ids)
+        pad_mask = torch.zeros_like(padding)
+        if self.is_encoder_decoder:
+            return torch.cat([input_ids, padding], dim=-1), torch.cat([attention_mask, pad_mask], dim=-1)
+        # decoder-only models continue from the end of the prompt, so they are padded on the left
+        return torch.cat([padding, input_ids], dim=-1), torch.cat([pad_mask, attention_mask], dim=-1)
 
-        return dp
+    def preprocess(self, dp):
+        return make_prompt(dp, is_encoder_decoder=self.is_encoder_decoder)
 
 
-    def generate(self, dp, model: AutoModelForSeq2SeqLM, tokenizer, nbeams, max_decode_len):
+    def generate(self, dp, model: AutoModelForSeq2SeqLM, tokenizer, nbeams, max_decode_len, stopping_criteria=None, with_confidence=False):
 
         inputs = tokenizer(dp["input_string"], return_tensors="pt", truncation=False)
-        input_ids = inputs.input_ids.cuda()
+        input_ids = inputs.input_ids.to(model.device)
+        attention_mask = None
+        if self.use_compile:
+            input_ids, attention_mask = self.pad_to_bucket(input_ids)
 
         if not model.config.is_encoder_decoder:
             max_decode_len = max_decode_len+input_ids.shape[-1] # because the param for causal LMs includes input tokens into length too
 
         gen_output = model.generate(inputs=input_ids,
+                                    attention_mask=attention_mask,
                                     return_dict_in_generate=True,
                                     decoder_input_ids=None,
-                                    output_scores=False,
+                                    output_scores=with_confidence,
                                     max_length=max_decode_len,
-                                    num_beams=nbeams)
+                                    num_beams=nbeams,
+                                    stopping_criteria=stopping_criteria)
 
         gen_tokids = gen_output["sequences"][0]
 
+        confidence = None
+        if with_confidence:
+            # log-probabilities of the generated tokens. scores are logits for greedy decoding, but normalized already with beam search
+            transition_scores = model.compute_transition_scores(gen_output["sequences"],
+                                                                gen_output["scores"],
+                                                                gen_output.get("beam_indices"),
+                                                                normalize_logits=(nbeams==1))
+            # the output is only as reliable as its least likely token. positions after the end of a beam have a score of 0.
+            confidence = torch.exp(transition_scores[0].float().min()).item()
+
         if not model.config.is_encoder_decoder:
             gen_tokids = gen_tokids[input_ids.shape[-1]:]   # it puts the input string in it too if the model is causallm
 
@@ -117,20 +228,47 @@ class HFPredictor(object):
             gen_tokids = gen_tokids[:-1]
 
         gen_string = tokenizer.decode(gen_tokids)
+        if with_confidence:
+            return gen_string, confidence
         return gen_string
 
 
 
-    def predict(self, dp):
+    def predict(self, dp, should_stop=None, evidence_only=False, with_confidence=False, nbeams=None):
+        '''
+        :param evidence_only: Stop generating once the REVISION: marker is reached, so that the output only contains the evidence.
+        :param with_confidence: Return a tuple (output, confidence), where confidence is the probability of the least likely generated token.
+        :param nbeams: Number of beams for this prediction, instead of the one given to the constructor.
+        '''
         newdp = self.preprocess(dp)
+
+        criteria = []
+        if should_stop is not None:
+            criteria.append(CancelCriteria(should_stop))
+        if evidence_only:
+            prompt_len = 0
+            if not self.is_encoder_decoder:
+                prompt_len = len(self.tokenizer(newdp["input_string"]).input_ids)
+                if self.use_compile:
+                    prompt_len = self.get_bucket_len(prompt_len)
+            criteria.append(StopStringCriteria(self.tokenizer, "REVISION:", prompt_len=prompt_len))
+        stopping_criteria = StoppingCriteriaList(criteria) if len(criteria)>0 else None
+
         pred_str = self.generate(newdp,
                       model=self.model,
                       tokenizer=self.tokenizer,
-                      nbeams=self.nbeams,
-                      max_decode_len=self.max_decode_len)
+                      nbeams=nbeams if nbeams is not None else self.nbeams,
+                      max_decode_len=self.max_decode_len,
+                      stopping_criteria=stopping_criteria,
+                      with_confidence=with_confidence)
+        confidence = None
+        if with_confidence:
+            pred_str, confidence = pred_str
         if not self.is_encoder_decoder:
             # for decoder-only models, the word EVIDENCE: is not generated and so has to be prepended again.
             # for enc-dec models it is generated by the model
             pred_str = f"EVIDENCE: {pred_str}"
+        if with_confidence:
+            return pred_str, confidence
         return pred_str
 
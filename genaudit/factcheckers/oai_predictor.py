@@ -0,0 +1,95 @@
+import asyncio
+import math
+import os
+
+import httpx
+from openai import AsyncOpenAI
+
+from .utils import make_prompt
+from ..async_utils import make_semaphore, run_cancellable
+
+
+class OpenaiCompatPredictor(object):
+    '''
+    Runs the fact-checking model behind an OpenAI-compatible completions endpoint (e.g. a vLLM or TGI server) instead of
+    in-process. The prompt is the same as the one used by HFPredictor, so the outputs can be parsed the same way.
+
+    Requests go through one pooled keep-alive client, and up to max_concurrency of them can be in flight at the same
+    time, which lets the server batch the sentences of a claim together (see predict_many).
+    '''
+    def __init__(self, model_name, base_url=None, api_key=None, served_model_name=None, max_decode_len=999,
+                 max_concurrency=16, timeout=120, is_encoder_decoder=False, **kwargs):
+        '''
+        :param model_name: Name of the model on the server (for the oai: protocol), or the base url of the server (for the http:/https: protocols).
+        :param base_url: Base url of the server when using the oai: protocol. If not given, the OPENAI_BASE_URL environment variable or the OpenAI API is used.
+        :param served_model_name: Name of the model on the server when using the http:/https: protocols. If not given, the first model listed by the server is used.
+        :param kwargs: Arguments meant for other predictors (e.g. gpu_idx, nbeams) are ignored.
+        '''
+        if model_name.startswith("http://") or model_name.startswith("https://"):
+            base_url = model_name
+            model_name = served_model_name
+
+        if api_key is None:
+            # local inference servers usually do not check the key, but the client insists on having one
+            api_key = os.environ.get("OPENAI_API_KEY", "EMPTY")
+
+        self.is_encoder_decoder = is_encoder_decoder
+        self.max_decode_len = max_decode_len
+        self.max_concurrency = max_concurrency
+
+        # all requests run on this loop, which is owned by the predictor, so that the client and its connection pool are reused across calls
+        self.loop = asyncio.new_event_loop()
+        http_client = httpx.AsyncClient(limits=httpx.Limits(max_connections=max_concurrency,
+                                                            max_keepalive_connections=max_concurrency),
+                                        timeout=timeout)
+        self.client = AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=http_client)
+        self.semaphore = make_semaphore(self.loop, self.max_concurrency)
+
+        if model_name is None:
+            model_name = self.loop.run_until_complete(self._get_first_model())
+        self.model_name = model_name
+
+    async def _get_first_model(self):
+        models = await self.client.models.list()
+        return models.data[0].id
+
+    def preprocess(self, dp):
+        return make_prompt(dp, is_encoder_decoder=self.is_encoder_decoder)
+
+    async def _apredict(self, dp, evidence_only=False, with_confidence=False):
+        newdp = self.preprocess(dp)
+        async with self.semaphore:
+            response = await self.client.completions.create(model=self.model_name,
+                                                            prompt=newdp["input_string"],
+                                                            max_tokens=self.max_decode_len,
+                                                            temperature=0,
+                                                            # the server leaves out the stop string itself, which the parser does not need
+                                                            stop=["REVISION:"] if evidence_only else None,
+                                                            logprobs=1 if with_confidence else None)
+        pred_str = response.choices[0].text.strip()
+        if not self.is_encoder_decoder:
+            # same as with HFPredictor, the prompt of decoder-only models already ends with EVIDENCE:
+            pred_str = f"EVIDENCE: {pred_str}"
+        if with_confidence:
+            # same as with HFPredictor, the probability of the least likely generated token
+            token_logprobs = [x for x in response.choices[0].logprobs.token_logprobs if x is not None]
+            confidence = math.exp(min(token_logprobs)) if len(token_logprobs)>0 else 0.0
+            return pred_str, confidence
+        return pred_str
+
+    def predict(self, dp, should_stop=None, evidence_only=False, with_confidence=False):
+        coro = self._apredict(dp, evidence_only=evidence_only, with_confidence=with_confidence)
+        return self.loop.run_until_complete(run_cancellable(coro, should_stop))
+
+    def predict_many(self, dps, should_stop=None, evidence_only=False, with_confidence=False):
+        '''
+        Sends all requests at once (up to max_concurrency in flight) and returns their outputs in the same order.
+        An exception raised for a request is returned in place of its output.
+        '''
+        async def run_all():
+            return await asyncio.gather(*[self._apredict(dp, evidence_only=evidence_only, with_confidence=with_confidence) for dp in dps],
+                                        return_exceptions=True)
+        outputs = self.loop.run_until_complete(run_cancellable(run_all(), should_stop))
+        if outputs is None:
+            return [None]*len(dps)
+        return outputs
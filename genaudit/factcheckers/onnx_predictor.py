@@ -0,0 +1,93 @@
+import argparse
+import os
+import tempfile
+
+from transformers import AutoTokenizer, AutoConfig
+from peft import PeftConfig
+
+from .hf_predictor import HFPredictor, load_merged_model
+
+try:
+    import onnxruntime
+    from optimum.onnxruntime import ORTModelForSeq2SeqLM, ORTModelForCausalLM
+except ImportError:
+    # optional (pip install genaudit[onnx]), only needed for the onnx: protocol
+    onnxruntime = None
+
+
+def get_ort_model_cls(config):
+    if config.is_encoder_decoder:
+        return ORTModelForSeq2SeqLM
+    else:
+        return ORTModelForCausalLM
+
+
+def export_onnx(model_name, output_dir):
+    '''
+    Merges the PEFT adapter of model_name into its base model and exports the result to ONNX in output_dir, as an
+    encoder and decoder graphs for encoder-decoder models, or a decoder graph for decoder-only ones. In both cases the
+    decoder comes with and without past key values, so that generation can use a KV cache.
+    '''
+    if onnxruntime is None:
+        print("Exporting to ONNX needs optimum and onnxruntime. Install them with: pip install genaudit[onnx]")
+        raise NotImplementedError
+
+    adapter_config = PeftConfig.from_pretrained(model_name)
+    tokenizer = AutoTokenizer.from_pretrained(adapter_config.base_model_name_or_path, use_fast=False)
+    model = load_merged_model(model_name, dtype="float32")
+
+    with tempfile.TemporaryDirectory() as merged_dir:
+        model.save_pretrained(merged_dir)
+        tokenizer.save_pretrained(merged_dir)
+        del model
+        ort_model = get_ort_model_cls(AutoConfig.from_pretrained(merged_dir)).from_pretrained(merged_dir, export=True, use_cache=True)
+        ort_model.save_pretrained(output_dir)
+        tokenizer.save_pretrained(output_dir)
+
+
+class OnnxPredictor(HFPredictor):
+    '''
+    Runs a fact-checking model exported with export_onnx in ONNX Runtime on CPU, without PyTorch kernels, bitsandbytes
+    or PEFT at inference time. Generation (beam search with a KV cache), stopping and the output format are the same as
+    with HFPredictor, so outputs are parsed the same way.
+    '''
+    def __init__(self, model_name, nbeams=4, max_decode_len=999, num_threads=None, **kwargs):
+        '''
+        :param model_name: Directory the model was exported to.
+        :param num_threads: Number of threads ONNX Runtime uses for each operator (all cores by default).
+        :param kwargs: Arguments meant for other predictors (e.g. gpu_idx) are ignored.
+        '''
+        if onnxruntime is None:
+            print("The onnx: protocol needs optimum and onnxruntime. Install them with: pip install genaudit[onnx]")
+            raise NotImplementedError
+
+        session_options = onnxruntime.SessionOptions()
+        if num_threads is not None:
+            session_options.intra_op_num_threads = num_threads
+
+        config = AutoConfig.from_pretrained(model_name)
+        self.model = get_ort_model_cls(config).from_pretrained(model_name,
+                                                               use_cache=True,
+                                                               provider="CPUExecutionProvider",
+                                                               session_options=session_options)
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=False)
+        if self.tokenizer.pad_token==None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+
+        self.is_encoder_decoder = config.is_encoder_decoder
+        self.max_decode_len = max_decode_len
+        self.nbeams = nbeams
+        # the graphs have dynamic shapes already, there is nothing to compile
+        self.use_compile = False
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='export a fact-checking model (base model with its adapter merged) to ONNX, for use with the onnx: protocol')
+
+    parser.add_argument("--model", type=str, required=True, help="the fact-checking model (adapter) to export, e.g. kundank/genaudit-usb-flanul2")
+    parser.add_argument("--output", type=str, required=True, help="directory to write the exported model to")
+
+    args = parser.parse_args()
+
+    export_onnx(args.model, args.output)
+    print(f"Exported {args.model} to {args.output}. Use it with --factcheck-model onnx:{os.path.abspath(args.output)}")
@@ -0,0 +1,28 @@
+import time
+
+
+class StubPredictor(object):
+    '''
+    Stand-in for a fact-checking model, for load tests and development on machines without a GPU. Each prediction takes
+    a fixed time and returns the claim unchanged, with the first sentence of the reference as its evidence.
+    '''
+    def __init__(self, model_name="", is_encoder_decoder=False, **kwargs):
+        '''
+        :param model_name: Time in seconds that each prediction takes (e.g. 0.2 for stub:0.2). No delay if empty.
+        :param kwargs: Arguments meant for other predictors (e.g. gpu_idx, nbeams) are ignored.
+        '''
+        self.delay = float(model_name) if model_name!="" else 0.0
+
+    def predict(self, dp, should_stop=None, evidence_only=False, with_confidence=False, **kwargs):
+        end_time = time.time()+self.delay
+        while time.time()<end_time:
+            if should_stop is not None and should_stop():
+                break
+            time.sleep(min(0.01, max(0.0, end_time-time.time())))
+
+        pred_str = "EVIDENCE: SENT0"
+        if not evidence_only:
+            pred_str = f"{pred_str} REVISION: {dp['before_summary_sent']}"
+        if with_confidence:
+            return pred_str, 1.0
+        return pred_str
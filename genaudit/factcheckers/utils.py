@@ -3,6 +3,38 @@ from nltk.tokenize import TreebankWordTokenizer as twt
 from collections import defaultdict
 import pdb
 
+
+def make_prompt(dp, is_encoder_decoder):
+    PROMPT_STR = "You are provided a document and its summary. The summary may potentially contain factual errors. The last sentence of the summary is marked as a claim. Find all sentences in the document providing evidence for the claim, and then revise the claim to remove or replace unsupported facts."
+    input_string = f"{PROMPT_STR} DOCUMENT:"
+    for _i,sent in enumerate(dp["input_lines"]):
+        input_string = f"{input_string} SENT{_i} {sent}"
+
+    input_string = f"{input_string} SUMMARY:"
+    for _k, sent in enumerate(dp["prev_summ_lines"]):
+        input_string = f"{input_string} {sent}"
+
+    input_string = f"{input_string} CLAIM: {dp['before_summary_sent']}"
+    output_string = ""
+
+    if is_encoder_decoder:
+        output_string = f"EVIDENCE:"
+    else:
+        input_string = f"{input_string} EVIDENCE:"
+
+    for ev_idx in dp["evidence_labels"]:
+        output_string = f"{output_string} SENT{ev_idx}"
+    output_string = f"{output_string} REVISION: {dp['after_summary_sent']}"
+
+    input_string = input_string.strip()
+    output_string = output_string.strip()
+
+    dp["input_string"] = input_string
+    dp["output_string"] = output_string
+
+    return dp
+
+
 def showdiff(fr, to, replace_empty=False):
     differ = difflib.Differ()
 
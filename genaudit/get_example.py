@@ -1,32 +1,189 @@
-import glob
 import json
 import os
+import sqlite3
+import threading
+import time
+
+from .annotation_store import AnnotationStore
+
+NEW_DOC_ID = "New (empty doc)"
+# modifications closer together than this may leave the mtime of a file or directory unchanged (e.g. on NFS or FAT)
+RECENT_NS = 1_000_000_000
+
 
 class ExampleGetter():
-    def __init__(self, samples_path, save_path):
+    '''
+    Serves the examples stored as json files in samples_path and save_path.
+
+    Instead of loading every file on each request, an index (id, path, mtime, size of each file) is kept in SQLite. On
+    refresh, only directories whose mtime changed are listed again, the files already known are stat'ed, and only new or
+    changed files are opened to read their id. Documents are loaded from disk when asked for, by their id.
+
+    If save_path holds an AnnotationStore (see annotation_store.py), the examples in it are served as well.
+    '''
+    def __init__(self, samples_path, save_path, index_path=None):
+        '''
+        :param index_path: Where to keep the index. Defaults to a file in the .genaudit_index directory inside save_path (so that it survives restarts), or to memory if there is no save_path.
+        '''
         self.samples_path = samples_path
         self.save_path = save_path
-        self.refresh()
 
-    def refresh(self):
-        all_files = glob.glob(f"{self.samples_path}/*.json")
         if self.save_path!="":
-            if os.path.exists(self.save_path) and os.path.isdir(self.save_path):
-                all_files += glob.glob(f"{self.save_path}/*.json")
-            else:
+            if not (os.path.exists(self.save_path) and os.path.isdir(self.save_path)):
                 print(f"ERROR: The given save path is not a valid directory: {self.save_path}")
                 raise OSError
-        self.full = [json.load(open(x)) for x in all_files]
-        self.full = sorted(self.full, key=lambda i:i["id"])
-        self.full = [{"input_lines":[], "output_lines":[], "id":"New (empty doc)"}] + self.full
+
+        if index_path is None and self.save_path!="":
+            # kept in a subdirectory, so that writes to the index (and its journal files) do not change the mtime of save_path itself
+            index_dir = os.path.join(self.save_path, ".genaudit_index")
+            os.makedirs(index_dir, exist_ok=True)
+            index_path = os.path.join(index_dir, "examples.sqlite")
+        elif index_path is None:
+            index_path = ":memory:"
+
+        self.store = None
+        if self.save_path!="" and AnnotationStore.is_store(self.save_path):
+            self.store = AnnotationStore(self.save_path)
+
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(index_path, check_same_thread=False)
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS examples (path TEXT PRIMARY KEY, dir TEXT, id TEXT, mtime INTEGER, size INTEGER)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS examples_id ON examples (id)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS dirs (dir TEXT PRIMARY KEY, mtime INTEGER)")
+        self.refresh()
+
+    def get_dirs(self):
+        dirs = [self.samples_path]
+        if self.save_path!="":
+            dirs.append(self.save_path)
+        return [os.path.abspath(x) for x in dirs]
+
+    def _list_dir(self, dirpath):
+        current = {}
+        with os.scandir(dirpath) as it:
+            for entry in it:
+                if entry.name.endswith(".json") and entry.is_file():
+                    st = entry.stat()
+                    current[entry.path] = (st.st_mtime_ns, st.st_size)
+        return current
+
+    def _stat_known(self, known):
+        current = {}
+        for path in known:
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            current[path] = (st.st_mtime_ns, st.st_size)
+        return current
+
+    def _update_dir(self, dirpath, current, known):
+        '''
+        :param current: Path -> (mtime, size) of the files in dirpath now.
+        :param known: Path -> (mtime, size) of the files in dirpath as stored in the index.
+        '''
+        now = time.time_ns()
+        with self.db:
+            for path in known:
+                if path not in current:
+                    self.db.execute("DELETE FROM examples WHERE path=?", (path,))
+
+            for (path, (mtime, size)) in current.items():
+                # a file written again within the mtime granularity of the filesystem can keep its mtime (and size), so
+                # recently modified files are read again until they are old enough
+                if known.get(path)==(mtime, size) and now-mtime>RECENT_NS:
+                    continue
+                try:
+                    with open(path, encoding="utf-8") as f:
+                        _id = json.load(f)["id"]
+                except (OSError, ValueError, KeyError):
+                    # could be a file which is still being written, it will be picked up on the next change of the file
+                    print(f"WARNING: Could not read example from {path}")
+                    continue
+                self.db.execute("INSERT OR REPLACE INTO examples (path, dir, id, mtime, size) VALUES (?, ?, ?, ?, ?)",
+                                (path, dirpath, _id, mtime, size))
+
+    def refresh(self):
+        with self.lock:
+            for dirpath in self.get_dirs():
+                dir_mtime = os.stat(dirpath).st_mtime_ns
+                row = self.db.execute("SELECT mtime FROM dirs WHERE dir=?", (dirpath,)).fetchone()
+                known = {path: (mtime, size) for (path, mtime, size) in
+                         self.db.execute("SELECT path, mtime, size FROM examples WHERE dir=?", (dirpath,))}
+
+                # a directory's mtime changes whenever files get added to it or removed from it, so only changed
+                # directories are listed again. one changed within the mtime granularity of the last listing may still
+                # get files added without its mtime changing, so it is listed until it is old enough.
+                if row is None or row[0]!=dir_mtime or time.time_ns()-dir_mtime<=RECENT_NS:
+                    current = self._list_dir(dirpath)
+                else:
+                    # files rewritten in place do not change the mtime of their directory
+                    current = self._stat_known(known)
+                self._update_dir(dirpath, current, known)
+                with self.db:
+                    self.db.execute("INSERT OR REPLACE INTO dirs (dir, mtime) VALUES (?, ?)", (dirpath, dir_mtime))
 
     def get_all_ids(self):
         self.refresh()
-        all_ids = [x["id"] for x in self.full]
-        return all_ids
+        with self.lock:
+            all_ids = [row[0] for row in self.db.execute("SELECT DISTINCT id FROM examples ORDER BY id")]
+        if self.store is not None:
+            all_ids = sorted(set(all_ids).union(self.store.ids()))
+        return [NEW_DOC_ID] + all_ids
+
+    def get_versions(self):
+        '''
+        :return: A dict from the id of every stored example to a string that changes whenever the example does (the path, mtime and size of its file), e.g. to skip examples which have been processed already without loading them.
+        '''
+        self.refresh()
+        with self.lock:
+            rows = self.db.execute("SELECT id, path FROM examples ORDER BY id, path").fetchall()
+        versions = {}
+        for (example_id, path) in rows:
+            # the first path of an id is the file that get_article reads. it is stat'ed again rather than taking the
+            # mtime from the index, so that a rewrite since the refresh is not missed.
+            if example_id in versions:
+                continue
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            versions[example_id] = f"{path}:{st.st_mtime_ns}:{st.st_size}"
+        if self.store is not None:
+            # get_article reads ids in the store from there, and records in the store never change
+            for example_id in self.store.ids():
+                versions[example_id] = "store"
+        return versions
+
+    def _find_path(self, example_id):
+        with self.lock:
+            row = self.db.execute("SELECT path FROM examples WHERE id=? ORDER BY path LIMIT 1", (example_id,)).fetchone()
+        return row[0] if row is not None else None
+
+    def has_file(self, example_id):
+        '''
+        :return: Whether an example with this id is stored as a json file (in samples_path or save_path).
+        '''
+        self.refresh()
+        return self._find_path(example_id) is not None
+
+    def get_article(self, example_id):
+        if example_id==NEW_DOC_ID:
+            example = {"input_lines":[], "output_lines":[], "id":NEW_DOC_ID}
+        elif self.store is not None and example_id in self.store:
+            example = self.store.get(example_id)
+        else:
+            path = self._find_path(example_id)
+            if path is None:
+                # it may have been saved after the last refresh
+                self.refresh()
+                path = self._find_path(example_id)
+            if path is None:
+                raise KeyError(example_id)
+            with open(path, encoding="utf-8") as f:
+                example: dict = json.load(f)
 
-    def get_article(self, article_index):
-        example: dict = self.full[article_index]
         input_lines = example["input_lines"]
         output_lines = example["output_lines"]
 
@@ -40,4 +197,3 @@ class ExampleGetter():
             return_obj["question"] = example["question"]
 
         return return_obj
-
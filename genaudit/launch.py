@@ -1,16 +1,25 @@
 import argparse
+import copy
 import os
 import json
-from bottle import Bottle, request, response, run, static_file
+from bottle import Bottle, request, response, run
 import bottle
 from paste import httpserver
 import time
 import threading
+import uuid
+import queue
 from torch.multiprocessing import Process, Queue, set_start_method, Event
 import torch
 from .factcheckers import FactChecker
 from .qa_models import QAModel
 from .get_example import ExampleGetter
+from .annotation_store import AnnotationStore
+from .assets import AssetCache
+from .scheduler import DeviceScheduler, parse_device_limits, get_fingerprint, FACTCHECK, QA, INTERACTIVE, BACKGROUND, PRIORITIES
+from .audit_cache import AuditCache, make_factcheck_payload, get_example_payloads
+from .streaming import format_sse, IncrementalSentencizer
+from .stats import LatencyStats, CascadeStats
 import spacy
 
 bottle.BaseRequest.MEMFILE_MAX = 10240000
@@ -18,30 +27,128 @@ bottle.BaseRequest.MEMFILE_MAX = 10240000
 web_root = f"{os.path.dirname(__file__)}/webroot/"
 samples_path = f"{os.path.dirname(__file__)}/examples/saved"
 
-def consumer_procroot(pidx, cls, args_dict, in_queue: Queue, res_queue: Queue, init_event:Event):
+def consumer_procroot(pidx, cls, args_dict, in_queue: Queue, res_queue: Queue, init_event:Event, cancel_event:Event, warmup=False):
     fc = cls(**args_dict)
+    if warmup and hasattr(fc, "warmup"):
+        # the first requests would otherwise be slow, while kernels, memory pools and caches get initialized on live traffic
+        start_time = time.time()
+        fc.warmup()
+        print(f"Process {pidx} warmed up in {time.time()-start_time:.1f}s")
     init_event.set()
 
     while True:
+        # the scheduler hands out one job at a time, and clears the cancel signal before handing out the next one
         inp = in_queue.get(block=True)
         key = inp["key"]
         payload = inp["payload"]
-        result = fc.predict(**payload)
+        if inp.get("stream", False):
+            # partial outputs are sent back as they get generated, ahead of the final result
+            def on_text(text, key=key):
+                res_queue.put({"key": key, "partial": text})
+            result = fc.predict_stream(**payload, on_text=on_text, should_stop=cancel_event.is_set)
+        else:
+            result = fc.predict(**payload, should_stop=cancel_event.is_set)
         had_success = result["success"]
-        if not had_success:
+        if result.get("cancelled", False):
+            print("Cancelled a prediction")
+        elif not had_success:
             print("WARNING: FAILED A PREDICTION")
 
         res_queue.put({"key": key, "payload":result})
 
 
-def manager_threadroot(lockdict, res_queue: Queue, results_dict):
+def manager_threadroot(lockdict, res_queue: Queue, results_dict, scheduler: DeviceScheduler, streams, cascade_stats=None):
     while True:
         out = res_queue.get(block=True)
-        key = out["key"]
-        results_dict[key] = out["payload"]
-        assert key in lockdict
-        event = lockdict[key]
-        event.set()
+        if "partial" in out:
+            # partial outputs only exist for streaming requests. if the stream got closed by the client already, they are dropped.
+            for key in scheduler.get_waiters(out["key"]):
+                if key in streams:
+                    streams[key].put({"key": key, "partial": out["partial"]})
+            continue
+
+        if "waiters" in out:
+            # sent by the scheduler for requests cancelled before the job they waited for finished
+            waiters = out["waiters"]
+        else:
+            waiters = scheduler.release(out["key"])
+            if cascade_stats is not None:
+                cascade_stats.add(out["payload"])
+
+        for (j, key) in enumerate(waiters):
+            # requests coalesced into one job each get their own copy of the result
+            payload = out["payload"] if j==0 else copy.deepcopy(out["payload"])
+            if key in streams:
+                # streaming requests read the final result from their own queue too
+                streams[key].put({"key": key, "payload": payload})
+                continue
+            if key not in lockdict:
+                # nobody waits for this result anymore (a streaming request whose client went away)
+                continue
+
+            results_dict[key] = payload
+            event = lockdict[key]
+            event.set()
+
+
+def strip_example(one_dp):
+    # lines are served stripped, which is also how the web UI sends them back for fact-checking
+    one_dp["input_lines"] = [x.strip() for x in one_dp["input_lines"]]
+    one_dp["output_lines"] = [x.strip() for x in one_dp["output_lines"]]
+    return one_dp
+
+
+def preaudit_threadroot(ex_getter: ExampleGetter, audit_cache: AuditCache, lockdict, results_dict, scheduler: DeviceScheduler, interval=60):
+    '''
+    Fact-checks the sentences of the stored examples ahead of time, so that /get_example and the fact-checking requests
+    made when an example is opened are answered from the audit cache. Jobs are submitted one at a time at the background
+    priority, and only while no other fact-checking job is waiting, so this only uses capacity that would otherwise be
+    idle. Examples saved or changed later are picked up on the next pass, every interval seconds. Examples audited
+    completely already (in the same version) are skipped without being loaded.
+    '''
+    while True:
+        num_audited = 0
+        audited_examples = audit_cache.get_audited_examples()
+        for (example_id, version) in ex_getter.get_versions().items():
+            if audited_examples.get(example_id)==version:
+                continue
+            try:
+                one_dp = strip_example(ex_getter.get_article(example_id))
+            except (KeyError, OSError):
+                # removed since the versions were listed
+                continue
+
+            all_audited = True
+            for payload in get_example_payloads(one_dp):
+                if payload is None:
+                    continue
+                fingerprint = get_fingerprint(FACTCHECK, payload)
+                if audit_cache.get(fingerprint, count=False) is not None:
+                    continue
+
+                while not scheduler.is_idle(FACTCHECK):
+                    time.sleep(1)
+
+                key = uuid.uuid4().hex
+                event = threading.Event()
+                lockdict[key] = event
+                scheduler.submit(kind=FACTCHECK, key=key, payload=payload, client="preaudit", priority=BACKGROUND,
+                                 fingerprint=fingerprint)
+                event.wait()
+                del lockdict[key]
+                recv_pred = results_dict.pop(key)
+                if recv_pred["success"]:
+                    audit_cache.put(fingerprint, recv_pred["result"])
+                    num_audited += 1
+                else:
+                    all_audited = False
+
+            if all_audited:
+                audit_cache.mark_audited(example_id, version)
+
+        if num_audited>0:
+            print(f"Pre-audited {num_audited} sentences of the stored examples")
+        time.sleep(interval)
 
 
 if __name__ == "__main__":
@@ -52,6 +159,9 @@ if __name__ == "__main__":
     parser.add_argument("--port", type=int, required=True, help="port to use for listening to requests")
     parser.add_argument("--qa-model", type=str, default="", help="model to use for answering questions (optional)")
     parser.add_argument("--factcheck-model", type=str, required=True, help="model to use for fact-checking claims")
+    parser.add_argument("--skip-warmup", action="store_true", help="start serving right after the fact-checking models are loaded, without first running them on a few sample prompts. the first requests will then be slower.")
+    parser.add_argument("--fc-compile", action="store_true", help="compile the fact-checking model with torch.compile (hf models only). prompts are padded to a few fixed lengths to limit recompilation, which happens during the warmup.")
+    parser.add_argument("--cascade-threshold", type=float, default=0.8, help="when several fact-checking models are given (comma separated, from cheapest to most expensive), sentences for which a model's confidence is below this are passed on to the next model.")
     parser.add_argument("--num-factcheck-processes", type=int, default=1, help="can spawn multiple models for factchecking sentences in parallel. useful if you have multiple gpus.")
     parser.add_argument("--max-doc-words", type=int, default=1500, help="maximum number of words allowed in the input. note that no truncation happens when doing fact-checking or QA. Set according to available GPU memory.")
     parser.add_argument("--fc-max-decode-len", type=int, default=250, help="maximum output length for the fact-checking model. should be set to around the expected maximum length of a sentence being factchecked.")
@@ -62,8 +172,17 @@ if __name__ == "__main__":
     parser.add_argument("--qa-nbeams", type=int, default=1, help="number of beams to use while decoding from the QA model")
     parser.add_argument("--qa-top-p", type=float, default=None, help="the value of p in the top-p sampling procedure with the QA model")
     parser.add_argument("--qa-quantize", type=str, default="16bit", help="quantization to use for the QA model (should be one of: 16bit/8bit/4bit)")
+    parser.add_argument("--factcheck-device", type=str, default="cuda", choices=["cuda", "cpu"], help="device to run the fact-checking model on (only for hf models). on cpu, the model is not quantized and its adapter is merged into the weights. onnx models always run on cpu, and setting cpu for them splits the cores between the processes.")
+    parser.add_argument("--factcheck-dtype", type=str, default="float32", choices=["float32", "bfloat16"], help="dtype of the fact-checking model when running on cpu. bfloat16 halves the memory but is only fast on cpus with native support for it.")
+    parser.add_argument("--share-factcheck-weights", action="store_true", help="with --factcheck-device cpu, merge the fact-checking model once into a checkpoint which all fact-checking processes memory-map, so that they share the same memory instead of each holding a copy.")
+    parser.add_argument("--factcheck-weights-cache", type=str, default=os.path.expanduser("~/.cache/genaudit"), help="directory to keep the merged checkpoint in when using --share-factcheck-weights")
     parser.add_argument("--use-single-gpu", action="store_true", help="if you want all models to be loaded on the same GPU, use this flag. Otherwise, each model is loaded on a different GPU.")
+    parser.add_argument("--device-concurrency", type=str, default="", help="maximum number of jobs (fact-checking or QA) running at the same time on a device. either a single number for all devices (e.g. 2) or a list of device:limit pairs (e.g. 0:2,1:1). unlimited by default.")
     parser.add_argument("--save-path", type=str, default="", help="path to a directory for saving data (reference doc, questions, and responses after potential editing).")
+    parser.add_argument("--no-preaudit", action="store_true", help="do not fact-check the stored examples in the background while the server is idle. results already in the audit cache are still served.")
+    parser.add_argument("--preaudit-interval", type=float, default=60, help="seconds to wait between passes over the stored examples when pre-auditing, e.g. to pick up newly saved ones")
+    parser.add_argument("--audit-cache-dir", type=str, default="", help="directory to keep the results of pre-auditing in (one sqlite file per fact-checking model and decoding parameters). defaults to the .genaudit_index directory of the save path, or to ~/.cache/genaudit without one.")
+    parser.add_argument("--save-format", type=str, default="json", choices=["json", "store"], help="how to save data in the save path. json writes one file per example, store appends to compressed segment files (see genaudit.annotation_store).")
 
 
     args = parser.parse_args()
@@ -72,7 +191,12 @@ if __name__ == "__main__":
     set_start_method('spawn')
 
 
+    annotation_store = None
+    if args.save_path!="" and args.save_format=="store":
+        annotation_store = AnnotationStore(args.save_path)
+
     ex_getter = ExampleGetter(samples_path=samples_path, save_path=args.save_path)
+    assets = AssetCache(web_root)
     app = Bottle()
 
 
@@ -87,40 +211,98 @@ if __name__ == "__main__":
 
     gpu_counter = 0
 
-    input_queue = Queue()
+    default_limit, device_limits = parse_device_limits(args.device_concurrency)
+    scheduler = DeviceScheduler(default_limit=default_limit, device_limits=device_limits)
+
     result_queue = Queue()
     results_dict = {}
 
     fc_towait_events = []
 
+    cpu_args = {}
+    if args.factcheck_device=="cpu":
+        if not args.factcheck_model.startswith(("hf:", "onnx:")):
+            print("ERROR: --factcheck-device cpu is only supported for hf and onnx models")
+            raise NotImplementedError
+        # split the cores between the processes, otherwise every process starts one thread per core and they slow each other down
+        cpu_args = {
+            "device": "cpu",
+            "dtype": args.factcheck_dtype,
+            "num_threads": max(1, os.cpu_count()//args.num_factcheck_processes),
+        }
+        if args.share_factcheck_weights:
+            if not args.factcheck_model.startswith("hf:"):
+                print("ERROR: --share-factcheck-weights is only supported for hf models")
+                raise NotImplementedError
+            if "," in args.factcheck_model or "@" in args.factcheck_model:
+                print("ERROR: --share-factcheck-weights does not support a cascade of fact-checking models")
+                raise NotImplementedError
+            from .factcheckers.hf_predictor import prepare_merged_weights
+            cpu_args["merged_weights_path"] = prepare_merged_weights(model_name=args.factcheck_model[len("hf:"):],
+                                                                     cache_dir=args.factcheck_weights_cache,
+                                                                     dtype=args.factcheck_dtype)
+            print(f"Fact-checking processes will share the weights in {cpu_args['merged_weights_path']}")
+    elif args.share_factcheck_weights:
+        print("ERROR: --share-factcheck-weights needs --factcheck-device cpu")
+        raise NotImplementedError
+
     for pidx in range(args.num_factcheck_processes):
         init_event = Event()
         fc_towait_events.append(init_event)
+        input_queue = Queue()
+        cancel_event = Event()
         constructor_args = {
             "model_name":args.factcheck_model,
             "gpu_idx": gpu_counter,
             "nbeams": args.fc_nbeams,
             "max_decode_len": args.fc_max_decode_len,
+            "cascade_threshold": args.cascade_threshold,
+            **cpu_args,
         }
-        proc = torch.multiprocessing.Process(target=consumer_procroot, args=(pidx, FactChecker, constructor_args , input_queue, result_queue, init_event))
+        if args.fc_compile:
+            constructor_args["use_compile"] = True
+        proc = torch.multiprocessing.Process(target=consumer_procroot, args=(pidx, FactChecker, constructor_args , input_queue, result_queue, init_event, cancel_event, not args.skip_warmup))
         proc.start()
-        if not args.use_single_gpu:
-            gpu_counter+=1
+        if args.factcheck_device=="cpu":
+            scheduler.add_worker(kind=FACTCHECK, device="cpu", in_queue=input_queue, res_queue=result_queue, cancel_event=cancel_event)
+        else:
+            scheduler.add_worker(kind=FACTCHECK, device=gpu_counter, in_queue=input_queue, res_queue=result_queue, cancel_event=cancel_event)
+            if not args.use_single_gpu:
+                gpu_counter+=1
 
     [ev.wait() for ev in fc_towait_events]
     print("Fact-checking models started. 🏁")
 
     lockdict = {}
-    manager_thread = threading.Thread(target=manager_threadroot, args=(lockdict,result_queue, results_dict))
+    streams = {}
+    # hit rates of the tiers of the fact-checking cascade (a single tier if only one model is given)
+    cascade_stats = CascadeStats([x.strip() for x in args.factcheck_model.split(",")])
+    manager_thread = threading.Thread(target=manager_threadroot, args=(lockdict,result_queue, results_dict, scheduler, streams, cascade_stats))
     manager_thread.start()
 
+    # results computed ahead of time are only valid for the model and decoding parameters they were computed with
+    model_fingerprint = get_fingerprint(FACTCHECK, {
+        "factcheck_model": args.factcheck_model,
+        "nbeams": args.fc_nbeams,
+        "max_decode_len": args.fc_max_decode_len,
+        "cascade_threshold": args.cascade_threshold,
+        "device": args.factcheck_device,
+        "dtype": args.factcheck_dtype,
+    })
+    audit_cache_dir = args.audit_cache_dir
+    if audit_cache_dir=="":
+        audit_cache_dir = os.path.join(args.save_path, ".genaudit_index") if args.save_path!="" else os.path.expanduser("~/.cache/genaudit")
+    audit_cache = AuditCache(audit_cache_dir, model_fingerprint)
+
     qa_model_available = args.qa_model!=""
 
     input_queue2 = Queue()
     result_queue2 = Queue()
     results_dict2 = {}
     lockdict2 = {}
+    streams2 = {}
     init_event2 = Event()
+    cancel_event2 = Event()
 
     if qa_model_available:
         constructor_args = {
@@ -133,14 +315,49 @@ if __name__ == "__main__":
             "quantize": args.qa_quantize,
             "nbeams": args.qa_nbeams
         }
-        proc2 = torch.multiprocessing.Process(target=consumer_procroot, args=(0, QAModel, constructor_args , input_queue2, result_queue2, init_event2))
+        proc2 = torch.multiprocessing.Process(target=consumer_procroot, args=(0, QAModel, constructor_args , input_queue2, result_queue2, init_event2, cancel_event2))
         proc2.start()
-        manager_thread2 = threading.Thread(target=manager_threadroot, args=(lockdict2,result_queue2, results_dict2))
+        scheduler.add_worker(kind=QA, device=gpu_counter, in_queue=input_queue2, res_queue=result_queue2, cancel_event=cancel_event2)
+        manager_thread2 = threading.Thread(target=manager_threadroot, args=(lockdict2,result_queue2, results_dict2, scheduler, streams2))
         manager_thread2.start()
 
         init_event2.wait()
         print("QA model started. 🏁")
 
+    scheduler.start()
+
+    if not args.no_preaudit:
+        preaudit_thread = threading.Thread(target=preaudit_threadroot, args=(ex_getter, audit_cache, lockdict, results_dict, scheduler, args.preaudit_interval), daemon=True)
+        preaudit_thread.start()
+
+    qa_ttft_stats = LatencyStats()
+    qa_stream_total_stats = LatencyStats()
+
+    def get_job_params(bundle):
+        # the client id is used for fair sharing between users. the web UI does not send one, so fall back to its session
+        # id (one per browser tab), since behind a proxy all users share the same remote address.
+        client = bundle.get("client_id") or bundle.get("session_id") or request.remote_addr
+        priority = bundle.get("priority", INTERACTIVE)
+        if priority not in PRIORITIES:
+            priority = INTERACTIVE
+        # the session id lets newer requests supersede older ones from the same browser tab, and lets the tab cancel all its work when closed
+        return {"client": client, "priority": priority, "session": bundle.get("session_id")}
+
+    key_lock = threading.Lock()
+
+    def make_job_key(bundle, registry, value):
+        '''
+        Picks the key of a new request and registers value (the event or queue its result is delivered to) under it in
+        registry, in one step so that two requests cannot pick the same key.
+        '''
+        with key_lock:
+            # the frontend may pick the id of a request itself so that it can cancel it later
+            key = bundle.get("request_id", "")
+            if key=="" or any(key in x for x in (lockdict, lockdict2, streams, streams2)) or scheduler.has_key(key):
+                key = uuid.uuid4().hex
+            registry[key] = value
+        return key
+
 
     @app.hook('after_request')
     def enable_cors():
@@ -148,6 +365,9 @@ if __name__ == "__main__":
         You need to add some headers to each request.
         Don't use the wildcard '*' for Access-Control-Allow-Origin in production.
         """
+        if request.path=="/" or request.path.startswith("/static/"):
+            # the web UI itself is only loaded by the browser from this server, so it does not need these
+            return
         response.headers['Access-Control-Allow-Origin'] = '*'
         response.headers['Access-Control-Allow-Methods'] = 'PUT, GET, POST, DELETE, OPTIONS'
         response.headers['Access-Control-Allow-Headers'] = 'Origin, Accept, Content-Type, X-Requested-With, X-CSRF-Token'
@@ -155,8 +375,7 @@ if __name__ == "__main__":
 
     @app.route('/')
     def serve_job():
-        html_str = open(os.path.join(web_root,"index.html")).read()
-        return html_str
+        return assets.serve("index.html", request)
 
     @app.route('/get_config', method=['GET'])
     def get_config():
@@ -171,38 +390,49 @@ if __name__ == "__main__":
                                 "max_decode_len": args.qa_max_decode_len,
                         },
             "max_doc_words": args.max_doc_words,
-            "save_path": args.save_path
+            "save_path": args.save_path,
+            "device_concurrency": args.device_concurrency
         }
 
+    @app.route('/get_stats', method=['GET'])
+    def get_stats():
+        return {"scheduler": scheduler.get_stats(),
+                "factcheck_cascade": cascade_stats.summary(),
+                "audit_cache": audit_cache.get_stats(),
+                "qa_stream": {"ttft_secs": qa_ttft_stats.summary(), "total_secs": qa_stream_total_stats.summary()}}
+
     @app.route('/get_all_ids', method=['GET'])
     def get_all_ids():
-        output = [{"label": x, "val":j} for (j,x) in enumerate(ex_getter.get_all_ids())]
+        # examples are looked up by their id rather than their position in the list, which can shift when new examples get saved
+        output = [{"label": x, "val":x} for x in ex_getter.get_all_ids()]
         return {"all_ids": output}
 
     @app.route('/static/<filename:path>')
     def send_static(filename):
-        return static_file(filename, root=web_root)
+        return assets.serve(filename, request)
 
 
-    @app.route('/get_example/<jobid>')
+    @app.route('/get_example/<jobid:path>')
     def get_example(jobid):
-        jobid = int(jobid)
-        one_dp = ex_getter.get_article(jobid)
+        try:
+            one_dp = ex_getter.get_article(jobid)
+        except KeyError:
+            response.status = 404
+            return {"success": False, "reason": f"No example found with id {jobid}"}
 
+        one_dp = strip_example(one_dp)
         return_obj_formatted = {}
         return_obj_formatted["job_id"] = one_dp["id"]
         return_obj_formatted["input_lines"] = one_dp["input_lines"]
         return_obj_formatted["output_lines"] = one_dp["output_lines"]
 
-        for i in range(len(return_obj_formatted["input_lines"])):
-            return_obj_formatted["input_lines"][i] = return_obj_formatted["input_lines"][i].strip()
-
-        for i in range(len(return_obj_formatted["output_lines"])):
-            return_obj_formatted["output_lines"][i] = return_obj_formatted["output_lines"][i].strip()
-
         if "question" in one_dp:
             return_obj_formatted["question"] = one_dp["question"]
 
+        # fact-checking results for the output lines computed in the background, or None for lines not audited yet
+        return_obj_formatted["audits"] = [audit_cache.get(get_fingerprint(FACTCHECK, x), count=False) if x is not None else None
+                                          for x in get_example_payloads(one_dp)]
+
         return return_obj_formatted
 
 
@@ -227,15 +457,18 @@ if __name__ == "__main__":
             "question": question
         }
 
-        curtime = str(time.time())
         event = threading.Event()
-        lockdict2[curtime] = event
-        input_queue2.put({"key": curtime, "payload": send_dp})
+        key = make_job_key(bundle, lockdict2, event)
+        # load tests send the same few questions over and over, and without this would mostly measure coalescing
+        fingerprint = get_fingerprint(QA, send_dp) if not bundle.get("skip_coalescing", False) else None
+        scheduler.submit(kind=QA, key=key, payload=send_dp, slot="qa", fingerprint=fingerprint, **get_job_params(bundle))
 
         event.wait()
 
-        del lockdict2[curtime]
-        recv_pred = results_dict2.pop(curtime)
+        del lockdict2[key]
+        recv_pred = results_dict2.pop(key)
+        if recv_pred.get("cancelled", False):
+            return {"success": False, "cancelled": True, "reason": "Request was cancelled."}
         qa_output =  recv_pred["result"]
 
         qa_output = qa_output.replace("\n", " ").strip()
@@ -244,6 +477,179 @@ if __name__ == "__main__":
 
         return {"success": True, "prediction": sents}
 
+    @app.route('/get_qa_stream', method=['POST'])
+    def get_qa_stream():
+        '''
+        Streaming version of /get_qa. Responds with server-sent events: "start" (with the request id), then "token" for
+        each piece of generated text and "sentence" for each sentence once it is complete, and finally "done".
+        '''
+        response.content_type = "text/event-stream"
+        response.headers["Cache-Control"] = "no-cache"
+
+        if not qa_model_available:
+            return format_sse("done", {"success": False, "reason": "QA model not running."})
+
+        bundle = request.forms.get("bundle")
+        bytes_string = bytes(bundle, encoding="raw_unicode_escape")
+        bundle = bytes_string.decode("utf-8", "strict")
+        bundle = json.loads(bundle)
+
+        article_lines = [x["txt"] for x in bundle["article_lines"]]
+        send_dp = {
+            "document": article_lines,
+            "question": bundle["question"]
+        }
+
+        stream_queue = queue.Queue()
+        key = make_job_key(bundle, streams2, stream_queue)
+        start_time = time.time()
+        scheduler.submit(kind=QA, key=key, payload=send_dp, slot="qa", stream=True, **get_job_params(bundle))
+
+        def generate():
+            finished = False
+            try:
+                yield format_sse("start", {"request_id": key})
+
+                sentencizer = IncrementalSentencizer(nlp)
+                num_sents = 0
+                got_first_token = False
+                while True:
+                    out = stream_queue.get()
+                    if "partial" not in out:
+                        break
+
+                    if not got_first_token:
+                        got_first_token = True
+                        qa_ttft_stats.add(time.time()-start_time)
+                    yield format_sse("token", {"text": out["partial"]})
+                    for sent in sentencizer.feed(out["partial"]):
+                        yield format_sse("sentence", {"index": num_sents, "text": sent})
+                        num_sents += 1
+
+                finished = True
+                recv_pred = out["payload"]
+                if recv_pred.get("cancelled", False):
+                    yield format_sse("done", {"success": False, "cancelled": True, "reason": "Request was cancelled."})
+                    return
+
+                for sent in sentencizer.finish():
+                    yield format_sse("sentence", {"index": num_sents, "text": sent})
+                    num_sents += 1
+
+                total_secs = time.time()-start_time
+                qa_stream_total_stats.add(total_secs)
+                yield format_sse("done", {"success": recv_pred["success"], "prediction": sentencizer.sents, "total_secs": total_secs})
+            finally:
+                del streams2[key]
+                if not finished:
+                    # the client went away while the answer was being generated
+                    scheduler.cancel(key)
+
+        return generate()
+
+    @app.route('/get_qa_with_audit', method=['POST'])
+    def get_qa_with_audit():
+        '''
+        Answers the question and fact-checks the answer at the same time. Each sentence of the answer is sent to the
+        fact-checking workers as soon as it is complete (with the sentences before it as context), while the rest of the
+        answer is still being generated. Responds with server-sent events: the same ones as /get_qa_stream, plus an
+        "audit" event with the fact-checking result for each sentence. "done" is sent after all sentences are audited.
+        '''
+        response.content_type = "text/event-stream"
+        response.headers["Cache-Control"] = "no-cache"
+
+        if not qa_model_available:
+            return format_sse("done", {"success": False, "reason": "QA model not running."})
+
+        bundle = request.forms.get("bundle")
+        bytes_string = bytes(bundle, encoding="raw_unicode_escape")
+        bundle = bytes_string.decode("utf-8", "strict")
+        bundle = json.loads(bundle)
+
+        article_lines = [x["txt"] for x in bundle["article_lines"]]
+        send_dp = {
+            "document": article_lines,
+            "question": bundle["question"]
+        }
+        job_params = get_job_params(bundle)
+
+        # results of the QA job and of all fact-checking jobs for its sentences arrive on the same queue
+        events_queue = queue.Queue()
+        qa_key = make_job_key(bundle, streams2, events_queue)
+        start_time = time.time()
+        scheduler.submit(kind=QA, key=qa_key, payload=send_dp, slot="qa", stream=True, **job_params)
+
+        def generate():
+            qa_finished = False
+            pending_audits = {}     # key of fact-checking job -> index of the sentence it checks
+            answer_sents = []
+
+            def submit_audit(sent):
+                fc_key = uuid.uuid4().hex
+                fc_dp = {
+                    "reference_sents": article_lines,
+                    "claim": sent,
+                    "prev_sents": list(answer_sents)
+                }
+                pending_audits[fc_key] = len(answer_sents)
+                answer_sents.append(sent)
+                streams[fc_key] = events_queue
+                scheduler.submit(kind=FACTCHECK, key=fc_key, payload=fc_dp, slot=f"qa-audit-{pending_audits[fc_key]}",
+                                 fingerprint=get_fingerprint(FACTCHECK, fc_dp), **job_params)
+                return format_sse("sentence", {"index": pending_audits[fc_key], "text": sent})
+
+            try:
+                yield format_sse("start", {"request_id": qa_key})
+
+                sentencizer = IncrementalSentencizer(nlp)
+                got_first_token = False
+                qa_secs = None
+                while not qa_finished or len(pending_audits)>0:
+                    out = events_queue.get()
+                    key = out["key"]
+
+                    if key==qa_key and "partial" in out:
+                        if not got_first_token:
+                            got_first_token = True
+                            qa_ttft_stats.add(time.time()-start_time)
+                        yield format_sse("token", {"text": out["partial"]})
+                        for sent in sentencizer.feed(out["partial"]):
+                            yield submit_audit(sent)
+
+                    elif key==qa_key:
+                        qa_finished = True
+                        recv_pred = out["payload"]
+                        if not recv_pred["success"]:
+                            # the pending audits get cancelled on the way out
+                            yield format_sse("done", {"success": False, "cancelled": recv_pred.get("cancelled", False), "reason": "Could not generate an answer."})
+                            return
+                        for sent in sentencizer.finish():
+                            yield submit_audit(sent)
+                        qa_secs = time.time()-start_time
+                        qa_stream_total_stats.add(qa_secs)
+
+                    else:
+                        idx = pending_audits.pop(key)
+                        del streams[key]
+                        recv_pred = out["payload"]
+                        audit = {"index": idx, "txt": answer_sents[idx], "success": recv_pred["success"]}
+                        if recv_pred.get("cancelled", False):
+                            audit["cancelled"] = True
+                        else:
+                            audit.update(recv_pred["result"])
+                        yield format_sse("audit", audit)
+
+                yield format_sse("done", {"success": True, "prediction": answer_sents, "qa_secs": qa_secs, "total_secs": time.time()-start_time})
+            finally:
+                del streams2[qa_key]
+                if not qa_finished:
+                    scheduler.cancel(qa_key)
+                for fc_key in list(pending_audits):
+                    del streams[fc_key]
+                    scheduler.cancel(fc_key)
+
+        return generate()
+
     @app.route('/get_ev_with_fixfactuality', method=['POST'])
     def get_factuality():
 
@@ -258,25 +664,49 @@ if __name__ == "__main__":
 
         article_lines = [x["txt"] for x in article_lines]
 
-        send_dp = {
-            "reference_sents": article_lines,
-            "claim": summary_line,
-            "prev_sents": prev_lines
-        }
+        send_dp = make_factcheck_payload(article_lines, summary_line, prev_lines, evidence_only=bundle.get("evidence_only", False))
+        fingerprint = get_fingerprint(FACTCHECK, send_dp)
+
+        # sentences of stored examples are usually audited already. load tests skip the cache, so that they measure the model.
+        if not bundle.get("skip_audit_cache", False):
+            cached_output = audit_cache.get(fingerprint)
+            if cached_output is not None:
+                return cached_output
 
-        curtime = str(time.time())
         event = threading.Event()
-        lockdict[curtime] = event
-        input_queue.put({"key": curtime, "payload": send_dp})
+        key = make_job_key(bundle, lockdict, event)
+        # identical requests in flight (e.g. several reviewers checking the same example) share one job, unless asked
+        # otherwise by load tests, which would then mostly measure coalescing
+        scheduler.submit(kind=FACTCHECK, key=key, payload=send_dp, slot=bundle.get("slot"),
+                         fingerprint=fingerprint if not bundle.get("skip_coalescing", False) else None, **get_job_params(bundle))
 
         event.wait()
 
-        del lockdict[curtime]
-        recv_pred = results_dict.pop(curtime)
+        del lockdict[key]
+        recv_pred = results_dict.pop(key)
+        if recv_pred.get("cancelled", False):
+            return {"evidence_labels": [], "todelete_spans": [], "replacement_strings": [], "success": False, "cancelled": True}
         fc_output = recv_pred["result"]
 
         return fc_output
 
+    @app.route('/cancel', method=['POST'])
+    def cancel():
+        # cancels either a single request (by its request_id) or everything pending for a session (by its session_id)
+        bundle = request.forms.get("bundle")
+        bytes_string = bytes(bundle, encoding="raw_unicode_escape")
+        bundle = bytes_string.decode("utf-8", "strict")
+        bundle = json.loads(bundle)
+
+        if "request_id" in bundle:
+            num_cancelled = int(scheduler.cancel(bundle["request_id"]))
+        elif "session_id" in bundle:
+            num_cancelled = scheduler.cancel_session(bundle["session_id"])
+        else:
+            return {"success": False, "reason": "Either request_id or session_id should be given."}
+
+        return {"success": True, "num_cancelled": num_cancelled}
+
 
     @app.route('/save_example', method=['POST'])
     def save_example():
@@ -292,16 +722,26 @@ if __name__ == "__main__":
 
         _id = save_obj["id"]
 
+        if annotation_store is not None:
+            # get_article reads ids in the store from there, so an example saved as a json file would get hidden
+            if ex_getter.has_file(_id) or not annotation_store.append(save_obj):
+                return {'success': False, 'reason': 'Object already exists with that ID'}
+            return {'success': True, 'reason': 'Object saved successfully'}
 
         output_fpath = f"{args.save_path}/{_id}.json"
 
-        if os.path.exists(output_fpath):
+        # the example is written to a temporary file first and then hard-linked to its final name, which fails if the
+        # name is taken. so two concurrent saves with the same id cannot both succeed, and readers never see a half-written file.
+        tmp_fpath = f"{args.save_path}/.{_id}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_fpath, "w", encoding="utf-8") as w:
+            json.dump(save_obj, w, ensure_ascii=False)
+        try:
+            os.link(tmp_fpath, output_fpath)
+        except FileExistsError:
             return {'success': False, 'reason': 'Object already exists with that ID'}
-
-        else:
-            with open(output_fpath, "w", encoding="utf-8") as w:
-                json.dump(save_obj, w, ensure_ascii=False)
-            return {'success': True, 'reason': 'Object saved successfully'}
+        finally:
+            os.remove(tmp_fpath)
+        return {'success': True, 'reason': 'Object saved successfully'}
 
 
     @app.route("/sent_tokenize", method=['POST'])
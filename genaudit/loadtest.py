@@ -0,0 +1,275 @@
+import argparse
+import glob
+import json
+import os
+import random
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from .stats import LatencyStats
+
+samples_path = f"{os.path.dirname(__file__)}/examples/saved"
+
+ENDPOINT_PATHS = {
+    "factcheck": "/get_ev_with_fixfactuality",
+    "qa": "/get_qa",
+    "sent_tokenize": "/sent_tokenize",
+    "check_length": "/check_length",
+}
+
+DEFAULT_QUESTION = "Summarize the document."
+
+
+def load_corpus(path):
+    '''
+    Loads documents to build requests from.
+    :param path: Either a directory of json files in the format of the saved examples (input_lines, output_lines and optionally question), or a jsonl file with one such example per line.
+    '''
+    if os.path.isdir(path):
+        examples = []
+        for fpath in sorted(glob.glob(f"{path}/*.json")):
+            with open(fpath, encoding="utf-8") as f:
+                examples.append(json.load(f))
+    else:
+        with open(path, encoding="utf-8") as f:
+            examples = [json.loads(line) for line in f if line.strip()!=""]
+
+    examples = [x for x in examples if len(x["input_lines"])>0 and len(x["output_lines"])>0]
+    if len(examples)==0:
+        print(f"ERROR: No usable examples (with both input_lines and output_lines) found in {path}")
+        raise ValueError
+    return examples
+
+
+def parse_mix(spec):
+    '''
+    Parses a request mix like "factcheck=10,qa=1" into a dict of relative weights.
+    '''
+    mix = {}
+    for part in spec.split(","):
+        endpoint, weight = part.split("=")
+        endpoint = endpoint.strip()
+        if endpoint not in ENDPOINT_PATHS:
+            print(f"ERROR: Unknown endpoint {endpoint} in the request mix. Should be one of {list(ENDPOINT_PATHS.keys())}")
+            raise ValueError
+        mix[endpoint] = float(weight)
+    return mix
+
+
+class TrafficGenerator(object):
+    '''
+    Makes random requests in the same shape as the ones sent by the web UI.
+    '''
+    def __init__(self, examples, mix, num_clients=8, seed=0):
+        self.examples = examples
+        self.endpoints = list(mix.keys())
+        self.weights = [mix[x] for x in self.endpoints]
+        self.num_clients = num_clients
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def next_request(self):
+        '''
+        :return: A tuple (endpoint, form data).
+        '''
+        with self.lock:
+            endpoint = self.rng.choices(self.endpoints, weights=self.weights)[0]
+            example = self.rng.choice(self.examples)
+            line_idx = self.rng.randrange(len(example["output_lines"]))
+            client_id = f"loadtest-{self.rng.randrange(self.num_clients)}"
+
+        article_lines = [{"txt": x, "section_name": "notneeded", "section_index": 0} for x in example["input_lines"]]
+        # every request gets its own session, so that requests of the same virtual client do not supersede each other
+        session_id = str(uuid.uuid4())
+
+        if endpoint=="factcheck":
+            bundle = {"article_lines": article_lines,
+                      "prev_lines": example["output_lines"][:line_idx],
+                      "summary_line": example["output_lines"][line_idx],
+                      "session_id": session_id,
+                      "slot": f"line-{line_idx}",
+                      "client_id": client_id,
+                      # the sentences of the bundled examples are pre-audited by the server, which would turn every request into a cache lookup
+                      "skip_audit_cache": True,
+                      # the bundled examples only have a few distinct sentences, which concurrent requests would mostly share jobs for
+                      "skip_coalescing": True}
+            return endpoint, {"bundle": json.dumps(bundle)}
+        elif endpoint=="qa":
+            bundle = {"article_lines": article_lines,
+                      "question": example.get("question", DEFAULT_QUESTION),
+                      "session_id": session_id,
+                      "client_id": client_id,
+                      "skip_coalescing": True}
+            return endpoint, {"bundle": json.dumps(bundle)}
+        elif endpoint=="sent_tokenize":
+            return endpoint, {"doc": " ".join(example["input_lines"])}
+        else:
+            return endpoint, {"doc": "\n".join(example["input_lines"])}
+
+
+def send_request(base_url, endpoint, data, timeout):
+    '''
+    :return: None if the request succeeded, otherwise a short description of the error.
+    '''
+    req = urllib.request.Request(f"{base_url}{ENDPOINT_PATHS[endpoint]}",
+                                 data=urllib.parse.urlencode(data).encode("utf-8"),
+                                 method="POST")
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            output = json.loads(resp.read())
+    except urllib.error.HTTPError as e:
+        return f"http_{e.code}"
+    except (urllib.error.URLError, OSError) as e:
+        return "timeout" if "timed out" in str(e) else "connection"
+    except ValueError:
+        return "bad_response"
+
+    if output.get("cancelled", False):
+        return "cancelled"
+    if output.get("success", True) is False:
+        return "unsuccessful"
+    return None
+
+
+class Recorder(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.first_start = None
+        self.last_end = None
+
+    def add(self, endpoint, start_time, end_time, error):
+        with self.lock:
+            if endpoint not in self.latencies:
+                self.latencies[endpoint] = LatencyStats(max_samples=1000000)
+                self.errors[endpoint] = {}
+            self.first_start = start_time if self.first_start is None else min(self.first_start, start_time)
+            self.last_end = end_time if self.last_end is None else max(self.last_end, end_time)
+        # latencies of failed requests are kept too, since a timeout is as slow for the user as a success
+        self.latencies[endpoint].add(end_time-start_time)
+        if error is not None:
+            with self.lock:
+                self.errors[endpoint][error] = self.errors[endpoint].get(error, 0)+1
+
+    def summary(self):
+        elapsed = max(self.last_end-self.first_start, 1e-6) if self.first_start is not None else 1e-6
+        endpoints = {}
+        total_requests = 0
+        total_errors = 0
+        for (endpoint, stats) in self.latencies.items():
+            latency = stats.summary()
+            num_errors = sum(self.errors[endpoint].values())
+            endpoints[endpoint] = {"requests": latency["count"],
+                                   "throughput_rps": (latency["count"]-num_errors)/elapsed,
+                                   "error_rate": num_errors/latency["count"],
+                                   "errors": self.errors[endpoint],
+                                   "latency_secs": latency}
+            total_requests += latency["count"]
+            total_errors += num_errors
+        return {"elapsed_secs": elapsed,
+                "requests": total_requests,
+                "throughput_rps": (total_requests-total_errors)/elapsed,
+                "error_rate": total_errors/total_requests if total_requests>0 else 0.0,
+                "endpoints": endpoints}
+
+
+def run_closed_loop(base_url, traffic, concurrency, duration, timeout):
+    '''
+    Runs `concurrency` virtual users, each sending its next request as soon as the previous one is answered.
+    '''
+    recorder = Recorder()
+    deadline = time.time()+duration
+
+    def user():
+        while time.time()<deadline:
+            endpoint, data = traffic.next_request()
+            start_time = time.time()
+            error = send_request(base_url, endpoint, data, timeout)
+            recorder.add(endpoint, start_time, time.time(), error)
+
+    threads = [threading.Thread(target=user) for _ in range(concurrency)]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+    return recorder.summary()
+
+
+def run_open_loop(base_url, traffic, rate, duration, timeout, max_in_flight, seed=0):
+    '''
+    Sends requests arriving at random (a Poisson process) at `rate` requests per second, whether or not the earlier
+    ones have been answered. Latencies are measured from the time a request was due, so that requests which had to wait
+    for a free connection (when more than max_in_flight are outstanding) are not reported as faster than they were.
+    '''
+    recorder = Recorder()
+    rng = random.Random(seed)
+
+    def send(endpoint, data, due_time):
+        error = send_request(base_url, endpoint, data, timeout)
+        recorder.add(endpoint, due_time, time.time(), error)
+
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        start_time = time.time()
+        due_time = start_time
+        while True:
+            due_time += rng.expovariate(rate)
+            if due_time>start_time+duration:
+                break
+            time.sleep(max(0.0, due_time-time.time()))
+            endpoint, data = traffic.next_request()
+            executor.submit(send, endpoint, data, due_time)
+        # the requests still in flight are waited for, and count towards the results
+    return recorder.summary()
+
+
+def format_summary(name, summary):
+    lines = [f"== {name}: {summary['requests']} requests in {summary['elapsed_secs']:.1f}s, "
+             f"{summary['throughput_rps']:.2f} successful req/s, error rate {summary['error_rate']:.1%}"]
+    for (endpoint, result) in sorted(summary["endpoints"].items()):
+        latency = result["latency_secs"]
+        lines.append(f"   {endpoint:<14} n={result['requests']:<6} {result['throughput_rps']:7.2f} req/s  "
+                     f"p50={latency['p50']:.3f}s p95={latency['p95']:.3f}s p99={latency['p99']:.3f}s  "
+                     f"errors={result['error_rate']:.1%} {result['errors'] if len(result['errors'])>0 else ''}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='generate load against a running genaudit server and report its throughput, latency and error rates')
+
+    parser.add_argument("--url", type=str, default="http://localhost:7000", help="base url of the server")
+    parser.add_argument("--corpus", type=str, default=samples_path, help="directory of saved examples (json files) or a jsonl file of examples to build requests from. the bundled examples are used by default.")
+    parser.add_argument("--mix", type=str, default="factcheck=10,qa=1,sent_tokenize=1,check_length=1", help="relative frequency of the requests to each endpoint (factcheck, qa, sent_tokenize, check_length)")
+    mode = parser.add_mutually_exclusive_group(required=True)
+    mode.add_argument("--rates", type=str, help="open loop: comma separated arrival rates (requests per second) to run one after the other, e.g. 1,2,4")
+    mode.add_argument("--concurrency", type=str, help="closed loop: comma separated numbers of concurrent users to run one after the other, e.g. 1,4,16")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to send requests for at each rate or concurrency")
+    parser.add_argument("--timeout", type=float, default=300, help="seconds after which a request counts as failed")
+    parser.add_argument("--max-in-flight", type=int, default=256, help="open loop: maximum number of requests outstanding at the same time")
+    parser.add_argument("--num-clients", type=int, default=8, help="number of distinct client ids to spread requests over (the server shares capacity fairly between clients)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default="", help="json file to write the full results to")
+
+    args = parser.parse_args()
+
+    base_url = args.url.rstrip("/")
+    traffic = TrafficGenerator(load_corpus(args.corpus), parse_mix(args.mix), num_clients=args.num_clients, seed=args.seed)
+
+    results = []
+    if args.rates is not None:
+        for rate in [float(x) for x in args.rates.split(",")]:
+            summary = run_open_loop(base_url, traffic, rate, args.duration, args.timeout, args.max_in_flight, seed=args.seed)
+            results.append({"mode": "open_loop", "rate": rate, **summary})
+            print(format_summary(f"rate {rate}/s", summary), flush=True)
+    else:
+        for concurrency in [int(x) for x in args.concurrency.split(",")]:
+            summary = run_closed_loop(base_url, traffic, concurrency, args.duration, args.timeout)
+            results.append({"mode": "closed_loop", "concurrency": concurrency, **summary})
+            print(format_summary(f"concurrency {concurrency}", summary), flush=True)
+
+    if args.output!="":
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
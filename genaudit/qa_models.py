@@ -5,20 +5,22 @@ import torch.nn.functional
 from transformers import AutoTokenizer, AutoModelForCausalLM, AutoModelForSeq2SeqLM, AutoConfig
 from transformers import T5ForConditionalGeneration, PegasusForConditionalGeneration
 
-from transformers import BitsAndBytesConfig
+from transformers import BitsAndBytesConfig, StoppingCriteriaList, TextStreamer
 
 import os
 import pdb
+import asyncio
+import time
+import functools
 
+import jsonlines
 import tiktoken
 
-from openai import OpenAI
+from .stopping import CancelCriteria
+from .rate_limit import RateLimiter, get_retry_after
+from .async_utils import make_semaphore, run_cancellable
 
-from tenacity import (
-    retry,
-    stop_after_attempt,
-    wait_random_exponential,
-)  # for exponential backoff
+from openai import AsyncOpenAI, RateLimitError, APIConnectionError, InternalServerError
 
 
 def make_prompt(dp):
@@ -31,7 +33,21 @@ def make_prompt(dp):
 
 
 
-def predict_generation(dp, model: AutoModelForCausalLM, tokenizer, nbeams, max_decode_len, do_sample=False, temperature=1.0, top_p=None, random_seed=1729):
+class CallbackStreamer(TextStreamer):
+    '''
+    Text streamer which hands every piece of decoded text to a callback instead of printing it.
+    '''
+    def __init__(self, tokenizer, on_text, skip_prompt):
+        super().__init__(tokenizer, skip_prompt=skip_prompt, skip_special_tokens=True)
+        self.on_text = on_text
+
+    def on_finalized_text(self, text, stream_end=False):
+        if text!="":
+            self.on_text(text)
+
+
+
+def predict_generation(dp, model: AutoModelForCausalLM, tokenizer, nbeams, max_decode_len, do_sample=False, temperature=1.0, top_p=None, random_seed=1729, stopping_criteria=None, streamer=None):
     inputs = tokenizer(dp["input_string"], return_tensors="pt", truncation=False)
     input_ids = inputs.input_ids.to(model.device)
     attention_mask = inputs.attention_mask.to(model.device)
@@ -54,6 +70,8 @@ def predict_generation(dp, model: AutoModelForCausalLM, tokenizer, nbeams, max_d
                                 top_p=top_p,
                                 do_sample=do_sample,
                                 temperature=temperature,
+                                stopping_criteria=stopping_criteria,
+                                streamer=streamer,
                                 )
     gen_tokids = gen_output["sequences"][0]
 
@@ -146,36 +164,63 @@ class HFPredictor(object):
         self.tokenizer = tokenizer
 
 
-    def predict(self, dp, nbeams, max_decode_len, temperature, dosample, top_p):
-        pred_str = predict_generation(dp, model=self.model, tokenizer=self.tokenizer, nbeams=nbeams, max_decode_len=max_decode_len, temperature=temperature, do_sample=dosample, top_p=top_p)
+    def predict(self, dp, nbeams, max_decode_len, temperature, dosample, top_p, should_stop=None):
+        stopping_criteria = None
+        if should_stop is not None:
+            stopping_criteria = StoppingCriteriaList([CancelCriteria(should_stop)])
+        pred_str = predict_generation(dp, model=self.model, tokenizer=self.tokenizer, nbeams=nbeams, max_decode_len=max_decode_len, temperature=temperature, do_sample=dosample, top_p=top_p, stopping_criteria=stopping_criteria)
+        return {"result": pred_str, "success": True}
+
+    def predict_stream(self, dp, nbeams, max_decode_len, temperature, dosample, top_p, on_text, should_stop=None):
+        if nbeams>1:
+            # streaming is not possible with beam search since the best beam is only known at the end
+            output = self.predict(dp, nbeams=nbeams, max_decode_len=max_decode_len, temperature=temperature, dosample=dosample, top_p=top_p, should_stop=should_stop)
+            on_text(output["result"])
+            return output
+
+        stopping_criteria = None
+        if should_stop is not None:
+            stopping_criteria = StoppingCriteriaList([CancelCriteria(should_stop)])
+        # for decoder-only models the prompt is part of the generated sequence, so it is skipped
+        streamer = CallbackStreamer(self.tokenizer, on_text=on_text, skip_prompt=not self.model.config.is_encoder_decoder)
+        pred_str = predict_generation(dp, model=self.model, tokenizer=self.tokenizer, nbeams=nbeams, max_decode_len=max_decode_len, temperature=temperature, do_sample=dosample, top_p=top_p, stopping_criteria=stopping_criteria, streamer=streamer)
         return {"result": pred_str, "success": True}
 
 
 
 class OpenaiPredictor(object):
-    def __init__(self, model_name):
+    def __init__(self, model_name, rpm=0, tpm=0, max_concurrency=8, max_retries=6, base_url=None):
+        '''
+        :param rpm: Requests per minute allowed for the model (0 for no limit).
+        :param tpm: Tokens per minute allowed for the model (0 for no limit). Both the prompt and max_tokens of a request count against it.
+        :param max_concurrency: Maximum number of requests in flight at the same time.
+        '''
         self.model_name = model_name
         self.tokenizer = tiktoken.encoding_for_model(model_name)
-        self.client = OpenAI(api_key = os.environ["OPENAI_API_KEY"])
-    def get_approx_promptlen(self,msgs):
+        self.count_tokens = functools.lru_cache(maxsize=1024)(lambda text: len(self.tokenizer.encode(text)))
+        self.max_retries = max_retries
+
+        # all requests run on this loop, so that many of them can be in flight at once while sharing one rate limiter.
+        # retries are done here rather than by the client, since only we know about the other requests in flight.
+        self.loop = asyncio.new_event_loop()
+        self.client = AsyncOpenAI(api_key = os.environ["OPENAI_API_KEY"], base_url=base_url, max_retries=0)
+        self.limiter = RateLimiter(rpm=rpm, tpm=tpm)
+        self.max_concurrency = max_concurrency
+        self.semaphore = make_semaphore(self.loop, self.max_concurrency)
+
+    def get_approx_promptlen(self, msgs, document=None):
         total_len = 0
         for obj in msgs:
-            total_len += len(self.tokenizer.encode(obj["content"]))
+            content = obj["content"]
+            if document is not None and document in content:
+                # the document is most of the prompt and is shared by all questions about it, so its length is looked up from the cache
+                total_len += self.count_tokens(document)
+                content = content.replace(document, "", 1)
+            total_len += len(self.tokenizer.encode(content))
         return total_len
 
-    @retry(wait=wait_random_exponential(min=1, max=5), stop=stop_after_attempt(6))
-    def get_response(self,msg_list, max_tokens=None):
-        response = self.client.chat.completions.create(
-            model=self.model_name,
-            messages=msg_list,
-            max_tokens=max_tokens
-                )
-        return response.choices[0].message.content
-
-    def predict(self, dp, max_decode_len, **kwargs):
-        msglist = [{"role":"user", "content":dp["input_string"]}]
-        max_tokens = max_decode_len
-        num_toks = self.get_approx_promptlen(msglist)
+    def check_promptlen(self, msglist, document=None):
+        num_toks = self.get_approx_promptlen(msglist, document=document)
 
         if self.model_name=="gpt-3.5-turbo-16k-0613" and num_toks>16000:
             print(f"Sequence length exceeds limit for model {self.model_name}")
@@ -185,12 +230,106 @@ class OpenaiPredictor(object):
             print(f"Sequence length exceeds limit for model {self.model_name}")
             raise AssertionError
 
-        prediction = self.get_response(msglist, max_tokens)
+        return num_toks
+
+    async def _create_with_retries(self, num_tokens, **create_args):
+        last_error = None
+        for attempt in range(self.max_retries):
+            await self.limiter.acquire(num_tokens)
+            try:
+                return await self.client.chat.completions.create(model=self.model_name, **create_args)
+            except RateLimitError as e:
+                # wait for as long as the server asks, and hold back all other requests in the meantime too
+                last_error = e
+                self.limiter.pause(get_retry_after(e.response.headers, default=2**attempt))
+            except (APIConnectionError, InternalServerError) as e:
+                last_error = e
+                await asyncio.sleep(min(2**attempt, 30))
+        raise last_error
+
+    async def get_response(self, msg_list, max_tokens=None, num_tokens=0):
+        async with self.semaphore:
+            response = await self._create_with_retries(num_tokens=num_tokens+(max_tokens or 0),
+                                                       messages=msg_list,
+                                                       max_tokens=max_tokens)
+        return response.choices[0].message.content
+
+    async def apredict(self, dp, max_decode_len):
+        msglist = [{"role":"user", "content":dp["input_string"]}]
+        num_toks = self.check_promptlen(msglist, document=dp.get("document"))
+
+        prediction = await self.get_response(msglist, max_decode_len, num_toks)
         return {"result": prediction, "success": True}
 
+    def predict(self, dp, max_decode_len, should_stop=None, **kwargs):
+        output = self.loop.run_until_complete(run_cancellable(self.apredict(dp, max_decode_len), should_stop))
+        if output is None:
+            return {"result": "", "success": False, "cancelled": True}
+        return output
+
+    def predict_many(self, dps, max_decode_len, **kwargs):
+        # all requests are started at once. the semaphore and the rate limiter decide how many actually go out at a time.
+        async def run_all():
+            return await asyncio.gather(*[self.apredict(dp, max_decode_len) for dp in dps], return_exceptions=True)
+
+        outputs = self.loop.run_until_complete(run_all())
+        return [x if not isinstance(x, BaseException) else {"result":"", "success":False} for x in outputs]
+
+    async def apredict_stream(self, dp, max_decode_len, on_text, should_stop=None):
+        msglist = [{"role":"user", "content":dp["input_string"]}]
+        num_toks = self.check_promptlen(msglist, document=dp.get("document"))
+
+        async with self.semaphore:
+            stream = await self._create_with_retries(num_tokens=num_toks+max_decode_len,
+                                                     messages=msglist,
+                                                     max_tokens=max_decode_len,
+                                                     stream=True)
+            prediction = ""
+            async for chunk in stream:
+                if should_stop is not None and should_stop():
+                    await stream.close()
+                    break
+                if len(chunk.choices)==0:
+                    continue
+                text = chunk.choices[0].delta.content
+                if text:
+                    prediction += text
+                    on_text(text)
+        return {"result": prediction, "success": True}
+
+    def predict_stream(self, dp, max_decode_len, on_text, should_stop=None, **kwargs):
+        return self.loop.run_until_complete(self.apredict_stream(dp, max_decode_len, on_text, should_stop))
+
+    def get_stats(self):
+        return self.limiter.get_stats()
+
+
+class StubPredictor(object):
+    '''
+    Stand-in for a QA model, for load tests and development on machines without a GPU. It answers every question with
+    the same sentence after a fixed time, streaming it word by word.
+    '''
+    def __init__(self, delay):
+        self.delay = delay
+
+    def predict_stream(self, dp, on_text, should_stop=None, **kwargs):
+        words = f"This is a placeholder answer to the question: {dp['question']}".split(" ")
+        prediction = ""
+        for (j, word) in enumerate(words):
+            if should_stop is not None and should_stop():
+                break
+            time.sleep(self.delay/len(words))
+            text = word if j==0 else f" {word}"
+            prediction += text
+            on_text(text)
+        return {"result": prediction, "success": True}
+
+    def predict(self, dp, should_stop=None, **kwargs):
+        return self.predict_stream(dp, on_text=lambda text: None, should_stop=should_stop)
+
 
 class QAModel(object):
-    def __init__(self, model_name, gpu_idx=0, quantize="16bit", nbeams=1, max_decode_len=500, temperature=1.0, dosample=True, top_p=0.9):
+    def __init__(self, model_name, gpu_idx=0, quantize="16bit", nbeams=1, max_decode_len=500, temperature=1.0, dosample=True, top_p=0.9, rpm=0, tpm=0, max_concurrency=8):
         parts = model_name.split(":")
         protocol = parts[0]
         model_name = ":".join(parts[1:])
@@ -198,9 +337,12 @@ class QAModel(object):
         if protocol=="hf":
             self.model = HFPredictor(gpu_idx=gpu_idx, model_path=model_name, quantize=quantize)
         elif protocol=="oai":
-            self.model = OpenaiPredictor(model_name=model_name)
+            self.model = OpenaiPredictor(model_name=model_name, rpm=rpm, tpm=tpm, max_concurrency=max_concurrency)
+        elif protocol=="stub":
+            # no model, for load tests (e.g. stub:2 takes 2s per answer)
+            self.model = StubPredictor(delay=float(model_name) if model_name!="" else 0.0)
         else:
-            print("Unrecognized protocol for initializing QAModel. Should be either hf(huggingface) or oai(OpenAI).")
+            print("Unrecognized protocol for initializing QAModel. Should be either hf(huggingface), oai(OpenAI) or stub(no model, for testing).")
             raise NotImplementedError
 
         self.max_decode_len = max_decode_len
@@ -210,18 +352,106 @@ class QAModel(object):
         self.nbeams = nbeams
 
 
-    def predict(self, document, question):
+    def predict(self, document, question, should_stop=None):
+        if type(document)==list:
+            document = " ".join(document)
+        dp = make_prompt({"document": document, "question": question})
+
+        try:
+            output = self.model.predict(dp=dp,
+                                      max_decode_len=self.max_decode_len,
+                                      temperature=self.temperature,
+                                      dosample=self.dosample,
+                                      top_p=self.top_p,
+                                      nbeams=self.nbeams,
+                                      should_stop=should_stop)
+        except:
+            return {"result":"", "success":False}
+
+        if should_stop is not None and should_stop():
+            # the generation was cut short, so the partial answer is not returned
+            return {"result":"", "success":False, "cancelled":True}
+        return output
+
+    def predict_stream(self, document, question, on_text, should_stop=None):
+        '''
+        Same as predict(), but on_text is called with each piece of the answer as soon as it gets generated.
+        '''
         if type(document)==list:
             document = " ".join(document)
         dp = make_prompt({"document": document, "question": question})
 
         try:
-            return self.model.predict(dp=dp,
+            output = self.model.predict_stream(dp=dp,
                                       max_decode_len=self.max_decode_len,
                                       temperature=self.temperature,
                                       dosample=self.dosample,
                                       top_p=self.top_p,
-                                      nbeams=self.nbeams)
+                                      nbeams=self.nbeams,
+                                      on_text=on_text,
+                                      should_stop=should_stop)
         except:
             return {"result":"", "success":False}
 
+        if should_stop is not None and should_stop():
+            return {"result":"", "success":False, "cancelled":True}
+        return output
+
+    def predict_many(self, items):
+        '''
+        Answers many questions at once. Backends which support it (OpenAI) run the requests concurrently, others answer them one by one.
+        :param items: A list of dicts, each with a "document" (a string or a list of sentences) and a "question".
+        :return: A list with the output for each item, in the same order.
+        '''
+        if not hasattr(self.model, "predict_many"):
+            return [self.predict(x["document"], x["question"]) for x in items]
+
+        dps = []
+        for x in items:
+            document = x["document"]
+            if type(document)==list:
+                document = " ".join(document)
+            dps.append(make_prompt({"document": document, "question": x["question"]}))
+
+        return self.model.predict_many(dps,
+                                       max_decode_len=self.max_decode_len,
+                                       temperature=self.temperature,
+                                       dosample=self.dosample,
+                                       top_p=self.top_p,
+                                       nbeams=self.nbeams)
+
+    def get_stats(self):
+        if hasattr(self.model, "get_stats"):
+            return self.model.get_stats()
+        return {}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='answer questions about documents in bulk with a QA model')
+
+    parser.add_argument("--model", type=str, required=True, help="model to use for answering questions (e.g. oai:gpt-4-0613)")
+    parser.add_argument("--input", type=str, required=True, help="jsonl file where each line has a document (string or list of sentences) and a question")
+    parser.add_argument("--output", type=str, required=True, help="jsonl file to write the input lines to, with the answer and success fields added")
+    parser.add_argument("--max-decode-len", type=int, default=500, help="maximum number of tokens to generate for each answer")
+    parser.add_argument("--rpm", type=int, default=0, help="requests per minute allowed for the model (for OpenAI models, 0 for no limit)")
+    parser.add_argument("--tpm", type=int, default=0, help="tokens per minute allowed for the model (for OpenAI models, 0 for no limit)")
+    parser.add_argument("--max-concurrency", type=int, default=8, help="maximum number of requests in flight at the same time (for OpenAI models)")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="number of questions sent at once before writing out their answers")
+
+    args = parser.parse_args()
+
+    qa_model = QAModel(model_name=args.model, max_decode_len=args.max_decode_len, dosample=False, top_p=None,
+                       rpm=args.rpm, tpm=args.tpm, max_concurrency=args.max_concurrency)
+
+    with jsonlines.open(args.input) as reader:
+        all_items = list(reader)
+
+    with jsonlines.open(args.output, "w") as writer:
+        for start in range(0, len(all_items), args.chunk_size):
+            chunk = all_items[start:start+args.chunk_size]
+            outputs = qa_model.predict_many(chunk)
+            for (item, output) in zip(chunk, outputs):
+                item["answer"] = output["result"]
+                item["success"] = output["success"]
+                writer.write(item)
+            print(f"Answered {start+len(chunk)}/{len(all_items)} questions. Stats: {qa_model.get_stats()}")
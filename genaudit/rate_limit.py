@@ -0,0 +1,94 @@
+import asyncio
+import time
+
+
+class TokenBucket(object):
+    '''
+    Budget which refills continuously at a fixed rate per minute, up to one minute's worth.
+    A rate of 0 (or None) means unlimited.
+    '''
+    def __init__(self, per_minute):
+        self.per_minute = per_minute if per_minute else 0
+        self.available = float(self.per_minute)
+        self.last_refill = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.available = min(self.per_minute, self.available + (now-self.last_refill)*self.per_minute/60.0)
+        self.last_refill = now
+
+    def wait_time(self, amount):
+        # seconds until `amount` is available. a request bigger than the whole budget only waits for a full bucket.
+        if self.per_minute==0:
+            return 0.0
+        self._refill()
+        amount = min(amount, self.per_minute)
+        if self.available>=amount:
+            return 0.0
+        return (amount-self.available)*60.0/self.per_minute
+
+    def take(self, amount):
+        if self.per_minute==0:
+            return
+        self._refill()
+        self.available -= min(amount, self.per_minute)
+
+
+class RateLimiter(object):
+    '''
+    Schedules requests to a rate-limited API within a requests-per-minute and a tokens-per-minute budget.
+
+    acquire() waits until both budgets allow the request. When the server still responds with a 429, pause() stops all
+    requests until the time given by its Retry-After header, instead of each request backing off on its own.
+    Meant to be used from a single asyncio event loop.
+    '''
+    def __init__(self, rpm=0, tpm=0):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.paused_until = 0.0
+
+        self.start_time = time.monotonic()
+        self.num_requests = 0
+        self.num_rate_limited = 0
+        self.num_tokens = 0
+
+    async def acquire(self, num_tokens):
+        while True:
+            wait = max(self.paused_until-time.monotonic(), self.requests.wait_time(1), self.tokens.wait_time(num_tokens))
+            if wait<=0:
+                break
+            await asyncio.sleep(wait)
+
+        self.requests.take(1)
+        self.tokens.take(num_tokens)
+        self.num_requests += 1
+        self.num_tokens += num_tokens
+
+    def pause(self, secs):
+        self.num_rate_limited += 1
+        self.paused_until = max(self.paused_until, time.monotonic()+secs)
+
+    def get_stats(self):
+        elapsed_mins = max(time.monotonic()-self.start_time, 1e-6)/60.0
+        return {"requests": self.num_requests,
+                "rate_limited": self.num_rate_limited,
+                "rate_limited_frac": self.num_rate_limited/self.num_requests if self.num_requests>0 else 0.0,
+                "requests_per_min": self.num_requests/elapsed_mins,
+                "tokens_per_min": self.num_tokens/elapsed_mins}
+
+
+def get_retry_after(headers, default):
+    '''
+    Reads how long to wait before retrying from the headers of a 429 response, falling back to `default` seconds.
+    '''
+    if headers is None:
+        return default
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"])/1000.0
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+    except ValueError:
+        # Retry-After can also be an http date, which is not worth parsing here
+        pass
+    return default
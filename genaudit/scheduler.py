@@ -0,0 +1,341 @@
+import collections
+import hashlib
+import json
+import threading
+import time
+import uuid
+
+INTERACTIVE = "interactive"
+BULK = "bulk"
+# only served when nothing else is queued, e.g. for pre-auditing stored examples while the server is idle
+BACKGROUND = "background"
+PRIORITIES = [INTERACTIVE, BULK, BACKGROUND]
+
+FACTCHECK = "factcheck"
+QA = "qa"
+
+# (priority, kind) classes in the order in which they get served. within a priority level, sentence fact-checks go
+# before QA because they are short and the UI is waiting on them, while a single QA generation can take a long time.
+PRIORITY_CLASSES = [(INTERACTIVE, FACTCHECK), (INTERACTIVE, QA), (BULK, FACTCHECK), (BULK, QA),
+                    (BACKGROUND, FACTCHECK), (BACKGROUND, QA)]
+
+# sent back in place of a model output when a job gets cancelled before it reaches a worker
+CANCELLED_PAYLOAD = {"result": None, "success": False, "cancelled": True}
+
+
+def parse_device_limits(spec):
+    '''
+    Parses the value of --device-concurrency.
+    :param spec: Either empty (no limit), a single integer applying to every device (e.g. "2"), or a comma separated list of device:limit pairs (e.g. "0:2,1:1" or "cpu:4").
+    :return: A tuple (default_limit, per_device_limits) where a limit of 0 means unlimited.
+    '''
+    spec = spec.strip()
+    if spec=="":
+        return 0, {}
+    if ":" not in spec:
+        return int(spec), {}
+
+    limits = {}
+    for part in spec.split(","):
+        device, limit = part.split(":")
+        # gpu indices are ints, cpu workers run on the device "cpu"
+        device = int(device) if device.isdigit() else device
+        limits[device] = int(limit)
+    return 0, limits
+
+
+def get_fingerprint(kind, payload):
+    '''
+    Identifies a job by its inputs, so that identical requests can share one job. The model and generation parameters
+    are fixed for each kind of job in a server, so they do not need to be part of it.
+    '''
+    data = json.dumps([kind, payload], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class _Worker(object):
+    def __init__(self, kind, device, in_queue, cancel_event):
+        self.kind = kind
+        self.device = device
+        self.in_queue = in_queue
+        self.cancel_event = cancel_event
+        self.running_key = None
+
+
+class DeviceScheduler(object):
+    '''
+    Decides which queued job runs next on which worker process.
+
+    Every worker process gets its own input queue and is handed at most one job at a time, so jobs wait here (in the
+    server process) rather than in the multiprocessing queues. This lets us serve jobs in order of their priority class,
+    round-robin between clients within a class so that one heavy user cannot starve the others, and cap the number of
+    jobs running concurrently on each device.
+
+    Requests are submitted under their own key, and wait for the result of a job. A request with the same fingerprint as
+    a job that is still queued or running (e.g. several reviewers checking the same sentence of the same example) is
+    attached to that job instead of creating a new one, and all requests waiting for a job get its result.
+
+    Requests can be cancelled explicitly by key, all at once for a session (e.g. when the browser tab goes away), or
+    implicitly when a newer request is submitted for the same (session, slot). A job is only dropped (if queued) or
+    stopped (if running, by setting the cancel event of its worker) once no request waits for it anymore.
+    '''
+    def __init__(self, default_limit=0, device_limits=None):
+        self.default_limit = default_limit
+        self.device_limits = device_limits if device_limits is not None else {}
+
+        self.workers = []
+        self.result_queues = {}     # kind -> queue where results for that kind of job are collected
+        self.running = {}   # job id -> worker
+        self.jobs = {}      # job id -> job, for all jobs that are queued or running
+        self.waiters = {}   # request key -> (job id, session, slot), for all requests waiting for a job
+        self.slots = {}     # (session, slot) -> key of the latest request submitted for it
+        self.flights = {}   # fingerprint -> id of the job computing it, for jobs that requests can still attach to
+        self.queues = {cls: collections.OrderedDict() for cls in PRIORITY_CLASSES}   # class -> client -> deque of jobs
+        self.cond = threading.Condition()
+
+        self.num_dispatched = collections.Counter()
+        self.total_wait_secs = collections.Counter()
+        self.num_cancelled = collections.Counter()
+        self.num_coalesced = collections.Counter()
+
+    def add_worker(self, kind, device, in_queue, res_queue, cancel_event):
+        with self.cond:
+            self.workers.append(_Worker(kind=kind, device=device, in_queue=in_queue, cancel_event=cancel_event))
+            self.result_queues[kind] = res_queue
+            self.cond.notify()
+
+    def get_limit(self, device):
+        return self.device_limits.get(device, self.default_limit)
+
+    def submit(self, kind, key, payload, client="", priority=INTERACTIVE, session=None, slot=None, stream=False, fingerprint=None):
+        '''
+        Queues a request. If both session and slot are given, any older request still pending for the same (session, slot)
+        is cancelled, since its result has been superseded (e.g. the user edited the same summary sentence again). If the
+        new request shares the job of the older one, the job is kept.
+        If stream is True, the worker sends back partial outputs while the job runs.
+        If fingerprint is given (see get_fingerprint) and a job with the same fingerprint is queued or running, the
+        request waits for the result of that job instead. If the job is still queued in a lower priority class than the
+        request, it moves up to the class of the request.
+        '''
+        if priority not in PRIORITIES:
+            raise ValueError(f"Unknown priority {priority}. Should be one of: {PRIORITIES}")
+
+        with self.cond:
+            if key in self.waiters:
+                # two pending requests under one key would get each other's results, and the second release would fail
+                raise ValueError(f"A request with the key {key} is already pending")
+            job_id = self.flights.get(fingerprint) if fingerprint is not None else None
+            if job_id is not None:
+                job = self.jobs[job_id]
+                job["waiters"].append(key)
+                self.num_coalesced[kind] += 1
+                if job_id not in self.running and PRIORITY_CLASSES.index((priority, kind))<PRIORITY_CLASSES.index(job["cls"]):
+                    self._move_up(job, (priority, kind))
+            else:
+                job_id = uuid.uuid4().hex
+                job = {"id": job_id, "payload": payload, "submit_time": time.time(), "kind": kind,
+                       "cls": (priority, kind), "client": client, "stream": stream,
+                       "fingerprint": fingerprint, "waiters": [key]}
+                self.jobs[job_id] = job
+                if fingerprint is not None:
+                    self.flights[fingerprint] = job_id
+                client_queues = self.queues[job["cls"]]
+                if client not in client_queues:
+                    client_queues[client] = collections.deque()
+                client_queues[client].append(job)
+                self.cond.notify()
+
+            self.waiters[key] = (job_id, session, slot)
+
+            if session is not None and slot is not None:
+                old_key = self.slots.get((session, slot))
+                if old_key is not None:
+                    # done after the new request got attached, so that if both wait for the same job (e.g. the same
+                    # sentence was sent again unchanged), the old request only stops waiting and the job goes on
+                    self._cancel(old_key)
+                self.slots[(session, slot)] = key
+
+    def _move_up(self, job, cls):
+        client_queues = self.queues[job["cls"]]
+        client_queues[job["client"]].remove(job)
+        if len(client_queues[job["client"]])==0:
+            del client_queues[job["client"]]
+        job["cls"] = cls
+        client_queues = self.queues[cls]
+        if job["client"] not in client_queues:
+            client_queues[job["client"]] = collections.deque()
+        client_queues[job["client"]].append(job)
+        self.cond.notify()
+
+    def is_idle(self, kind):
+        '''
+        :return: Whether no job of this kind is queued and at least one of its workers is free.
+        '''
+        with self.cond:
+            if any(len(self.queues[cls])>0 for cls in PRIORITY_CLASSES if cls[1]==kind):
+                return False
+            return self._find_idle_worker(kind) is not None
+
+    def has_key(self, key):
+        with self.cond:
+            return key in self.waiters
+
+    def _forget_waiter(self, key):
+        _, session, slot = self.waiters.pop(key)
+        if self.slots.get((session, slot))==key:
+            del self.slots[(session, slot)]
+
+    def _forget(self, job_id):
+        job = self.jobs.pop(job_id, None)
+        if job is None:
+            return []
+        if self.flights.get(job["fingerprint"])==job_id:
+            del self.flights[job["fingerprint"]]
+        for key in job["waiters"]:
+            self._forget_waiter(key)
+        return job["waiters"]
+
+    def get_waiters(self, job_id):
+        # keys of the requests waiting for a job, e.g. to hand them its partial outputs
+        with self.cond:
+            job = self.jobs.get(job_id)
+            return list(job["waiters"]) if job is not None else []
+
+    def release(self, job_id):
+        '''
+        Called once the result for a dispatched job has come back, which frees up its worker and device slot.
+        :return: Keys of the requests which were waiting for this result.
+        '''
+        with self.cond:
+            worker = self.running.pop(job_id, None)
+            if worker is not None:
+                worker.running_key = None
+            waiters = self._forget(job_id)
+            self.cond.notify()
+            return waiters
+
+    def _send_cancelled(self, kind, job_id, waiters):
+        # results sent by the scheduler itself carry the requests they are meant for, since no job needs to be released
+        self.result_queues[kind].put({"key": job_id, "waiters": waiters, "payload": dict(CANCELLED_PAYLOAD)})
+
+    def _cancel(self, key):
+        if key not in self.waiters:
+            return False
+        job = self.jobs[self.waiters[key][0]]
+
+        if len(job["waiters"])>1:
+            # other requests still wait for this job, so only this one stops waiting
+            job["waiters"].remove(key)
+            self._forget_waiter(key)
+            self.num_cancelled["detached"] += 1
+            self._send_cancelled(job["kind"], job["id"], [key])
+            return True
+
+        worker = self.running.get(job["id"])
+        if worker is not None:
+            if job.get("cancelled", False):
+                return True
+            job["cancelled"] = True
+            # new identical requests must not attach to a job that is being stopped
+            if self.flights.get(job["fingerprint"])==job["id"]:
+                del self.flights[job["fingerprint"]]
+            # the worker checks this event between generation steps and returns early. its (cancelled) result then
+            # comes back through the usual path, which releases the worker.
+            worker.cancel_event.set()
+            self.num_cancelled["running"] += 1
+            return True
+
+        client_queues = self.queues[job["cls"]]
+        jobs = client_queues[job["client"]]
+        jobs.remove(job)
+        if len(jobs)==0:
+            del client_queues[job["client"]]
+        waiters = self._forget(job["id"])
+        self.num_cancelled["queued"] += 1
+        self._send_cancelled(job["kind"], job["id"], waiters)
+        return True
+
+    def cancel(self, key):
+        with self.cond:
+            return self._cancel(key)
+
+    def cancel_session(self, session):
+        with self.cond:
+            keys = [k for (k, (_, s, _)) in self.waiters.items() if s==session]
+            for key in keys:
+                self._cancel(key)
+            return len(keys)
+
+    def _num_running_on(self, device):
+        return sum(1 for w in self.workers if w.device==device and w.running_key is not None)
+
+    def _find_idle_worker(self, kind):
+        for worker in self.workers:
+            if worker.kind!=kind or worker.running_key is not None:
+                continue
+            limit = self.get_limit(worker.device)
+            if limit>0 and self._num_running_on(worker.device)>=limit:
+                continue
+            return worker
+        return None
+
+    def _pop_next(self):
+        # returns the next (class, job, worker) to dispatch, or None if nothing can run right now
+        for cls in PRIORITY_CLASSES:
+            client_queues = self.queues[cls]
+            if len(client_queues)==0:
+                continue
+            worker = self._find_idle_worker(kind=cls[1])
+            if worker is None:
+                continue
+
+            # round-robin over clients: take from the first one and move it to the back if it still has work left
+            client, jobs = next(iter(client_queues.items()))
+            job = jobs.popleft()
+            del client_queues[client]
+            if len(jobs)>0:
+                client_queues[client] = jobs
+            return cls, job, worker
+        return None
+
+    def run(self):
+        while True:
+            with self.cond:
+                picked = self._pop_next()
+                while picked is None:
+                    self.cond.wait()
+                    picked = self._pop_next()
+
+                cls, job, worker = picked
+                # a cancel signal left over from the previous job must be cleared here, under the lock, before the job
+                # counts as running. clearing it in the worker once it reads the job would lose a cancel sent in between.
+                worker.cancel_event.clear()
+                worker.running_key = job["id"]
+                self.running[job["id"]] = worker
+                self.num_dispatched[cls] += 1
+                self.total_wait_secs[cls] += time.time()-job["submit_time"]
+
+            worker.in_queue.put({"key": job["id"], "payload": job["payload"], "stream": job["stream"]})
+
+    def start(self):
+        thread = threading.Thread(target=self.run, daemon=True)
+        thread.start()
+        return thread
+
+    def get_stats(self):
+        with self.cond:
+            stats = {}
+            for cls in PRIORITY_CLASSES:
+                name = f"{cls[0]}_{cls[1]}"
+                num = self.num_dispatched[cls]
+                stats[name] = {
+                    "queued": sum(len(x) for x in self.queues[cls].values()),
+                    "dispatched": num,
+                    "mean_wait_secs": self.total_wait_secs[cls]/num if num>0 else 0.0,
+                }
+            stats["cancelled"] = dict(self.num_cancelled)
+            # requests which got the result of an identical job instead of running their own
+            stats["coalesced"] = dict(self.num_coalesced)
+            devices = sorted(set(w.device for w in self.workers))
+            stats["devices"] = {str(d): {"running": self._num_running_on(d), "limit": self.get_limit(d)} for d in devices}
+            return stats
@@ -0,0 +1,68 @@
+import collections
+import threading
+
+
+class LatencyStats(object):
+    '''
+    Keeps the most recent latency samples (in seconds) of some operation and summarizes them.
+    '''
+    def __init__(self, max_samples=1000):
+        self.samples = collections.deque(maxlen=max_samples)
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def add(self, secs):
+        with self.lock:
+            self.samples.append(secs)
+            self.count += 1
+
+    def summary(self):
+        with self.lock:
+            samples = sorted(self.samples)
+            count = self.count
+
+        if len(samples)==0:
+            return {"count": count}
+
+        def percentile(p):
+            return samples[min(len(samples)-1, int(p/100*len(samples)))]
+
+        return {"count": count,
+                "mean": sum(samples)/len(samples),
+                "p50": percentile(50),
+                "p95": percentile(95),
+                "p99": percentile(99),
+                "max": samples[-1]}
+
+
+class CascadeStats(object):
+    '''
+    Counts, for each tier of a fact-checking cascade, how many sentences reached it and how many it settled (its hit
+    rate), from the "tier" and "escalations" fields of fact-checking outputs.
+    '''
+    def __init__(self, tier_names):
+        self.tier_names = tier_names
+        self.reached = [0]*len(tier_names)
+        self.accepted = [0]*len(tier_names)
+        self.escalations = [collections.Counter() for _ in tier_names]
+        self.lock = threading.Lock()
+
+    def add(self, output):
+        if output.get("tier") is None:
+            return
+        with self.lock:
+            for (tier, reason) in enumerate(output.get("escalations", [])):
+                self.reached[tier] += 1
+                self.escalations[tier][reason] += 1
+            self.reached[output["tier"]] += 1
+            if output["success"]:
+                self.accepted[output["tier"]] += 1
+
+    def summary(self):
+        with self.lock:
+            return [{"name": name,
+                     "reached": self.reached[j],
+                     "accepted": self.accepted[j],
+                     "hit_rate": self.accepted[j]/self.reached[j] if self.reached[j]>0 else 0.0,
+                     "escalated": dict(self.escalations[j])}
+                    for (j, name) in enumerate(self.tier_names)]
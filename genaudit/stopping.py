@@ -0,0 +1,32 @@
+from transformers import StoppingCriteria
+
+
+class CancelCriteria(StoppingCriteria):
+    '''
+    Stops generation at the next decoding step once should_stop() returns True, e.g. when the request that started
+    the generation has been cancelled.
+    '''
+    def __init__(self, should_stop):
+        self.should_stop = should_stop
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return self.should_stop()
+
+
+class StopStringCriteria(StoppingCriteria):
+    '''
+    Stops generation once every sequence being generated (i.e. every beam) contains stop_string, e.g. to stop after the
+    evidence part of a fact-checking output when the revision is not needed.
+    '''
+    def __init__(self, tokenizer, stop_string, prompt_len=0):
+        '''
+        :param prompt_len: Number of input tokens at the start of each sequence (for causal LMs), which are not searched for stop_string.
+        '''
+        self.tokenizer = tokenizer
+        self.stop_string = stop_string
+        self.prompt_len = prompt_len
+
+    def __call__(self, input_ids, scores, **kwargs):
+        # the generated part is short when this is used, so decoding it again at every step is cheap
+        texts = self.tokenizer.batch_decode(input_ids[:, self.prompt_len:])
+        return all(self.stop_string in x for x in texts)
@@ -0,0 +1,67 @@
+import json
+
+
+def format_sse(event, data):
+    # one server-sent event. the data is always a json object so that the client can parse every event the same way
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+class IncrementalSentencizer(object):
+    '''
+    Splits text into sentences while it is still being generated.
+
+    Text is fed in chunks as it arrives. A sentence is reported as complete once spaCy places a sentence boundary after
+    it, i.e. once some text of the next sentence has arrived. Only the text after the last completed sentence is
+    re-parsed, and only when a chunk could have ended a sentence, so the cost stays small for long answers.
+    '''
+    SENTENCE_END_CHARS = ".?!:;\"')]"
+
+    def __init__(self, nlp):
+        self.nlp = nlp
+        self.text = ""
+        self.offset = 0     # character offset in self.text up to which sentences have been reported
+        self.sents = []
+        self.may_have_boundary = False
+
+    def _split_tail(self):
+        tail = self.text[self.offset:]
+        if tail.strip()=="":
+            return []
+        doc = self.nlp(tail)
+        return list(doc.sents)
+
+    def feed(self, chunk):
+        '''
+        :param chunk: Newly generated text.
+        :return: A list of sentences which got completed by this chunk (possibly empty).
+        '''
+        chunk = chunk.replace("\n", " ")
+        if any(c in self.SENTENCE_END_CHARS for c in chunk):
+            self.may_have_boundary = True
+        self.text += chunk
+
+        # a new sentence can only be confirmed once non-space text follows a sentence-ending character
+        if not self.may_have_boundary or chunk.strip()=="":
+            return []
+
+        spans = self._split_tail()
+        completed = []
+        for span in spans[:-1]:
+            completed.append(str(span).strip())
+        if len(spans)>1:
+            self.offset += spans[-1].start_char
+            self.may_have_boundary = any(c in self.SENTENCE_END_CHARS for c in self.text[self.offset:])
+
+        completed = [x for x in completed if x!=""]
+        self.sents.extend(completed)
+        return completed
+
+    def finish(self):
+        '''
+        :return: The sentences left over at the end of the text, which were not reported by feed() yet.
+        '''
+        remaining = [str(span).strip() for span in self._split_tail()]
+        remaining = [x for x in remaining if x!=""]
+        self.offset = len(self.text)
+        self.sents.extend(remaining)
+        return remaining
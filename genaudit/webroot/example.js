@@ -175,6 +175,9 @@ function make_toast(header, body){
 angular.module('newapp', ['ngAnimate', 'ngSanitize', 'ui.bootstrap']);
 angular.module('newapp').controller('FactChecker', function ($scope, $http) {
 
+    // identifies this browser tab to the server, so that newer requests can supersede older ones and pending work can be cancelled when the tab is closed
+    $scope.session_id = Math.random().toString(36).substring(2) + Date.now().toString(36);
+
     $scope.init_editor = function () {
 
         var cm = CodeMirror.fromTextArea(document.getElementById("notearea"), {
@@ -402,7 +405,8 @@ angular.module('newapp').controller('FactChecker', function ($scope, $http) {
         $scope.qa_generic = function(){
             this_obj = {
                 "article_lines" : $scope.get_formatted_src_text(),
-                "question": $("#question_txt").val()
+                "question": $("#question_txt").val(),
+                "session_id": $scope.session_id
             };
 
             $("#qa_button").prop("disabled",true)
@@ -827,10 +831,25 @@ angular.module('newapp').controller('FactChecker', function ($scope, $http) {
             }
 
 
+        function cancelRequest(request_id){
+            $.ajax({
+                url: './cancel',
+                type: "POST",
+                data: {"bundle": JSON.stringify({"request_id": request_id})}
+            });
+        }
+
         function queueUpdate(txt, line_code, curtime) {
 
                 const old_source_txt = $scope.src_cm.getValue();
 
+                // a check still running on the server for this line is outdated now, and its result would be thrown away.
+                // stop it right away instead of letting the new check wait behind it.
+                if (line_code in $scope.facteval_inflight){
+                    cancelRequest($scope.facteval_inflight[line_code]);
+                    delete $scope.facteval_inflight[line_code];
+                }
+
                 $scope.facteval_promisechain[line_code] = $scope.facteval_promisechain[line_code].then(function(x){
 
                     return new Promise(async (resolve,reject)=> {
@@ -882,6 +901,8 @@ angular.module('newapp').controller('FactChecker', function ($scope, $http) {
 
                     console.log("GETTING EVIDENCE AND FIX ...");
 
+                    const request_id = $scope.session_id + "-" + Math.random().toString(36).substring(2);
+                    $scope.facteval_inflight[line_code] = request_id;
 
                     $.ajax({
                         url: './get_ev_with_fixfactuality',
@@ -890,9 +911,16 @@ angular.module('newapp').controller('FactChecker', function ($scope, $http) {
                             "bundle": JSON.stringify({
                                     "article_lines": $scope.get_formatted_src_text(),
                                     "prev_lines": prev_lines,
-                                    "summary_line": txt
+                                    "summary_line": txt,
+                                    "session_id": $scope.session_id,
+                                    "slot": line_code,
+                                    "request_id": request_id
                                       })
                               },
+                        complete: function (){
+                                    if ($scope.facteval_inflight[line_code]===request_id)
+                                        delete $scope.facteval_inflight[line_code];
+                              },
                         success: function (resp){
                                     console.log(resp);
                                     console.log("executing...===");
@@ -1276,7 +1304,7 @@ angular.module('newapp').controller('FactChecker', function ($scope, $http) {
         $scope.job_id = job_id;
         $.ajax({
             type: "GET",
-            url: "./get_example/"+job_id,
+            url: "./get_example/"+encodeURIComponent(job_id),
             success: function (data) {
                 console.log(data);
                 load_datapoint($scope, data);
@@ -1293,9 +1321,9 @@ angular.module('newapp').controller('FactChecker', function ($scope, $http) {
                 console.log(data);
                 $scope.all_example_ids = data["all_ids"];
                 $scope.$apply();
-                example_to_show_idx = 0;
-                $("#selectex").val(example_to_show_idx);
-                $scope.refresh_datapoint(example_to_show_idx);
+                example_to_show_id = $scope.all_example_ids[0]["val"];
+                $("#selectex").val(example_to_show_id);
+                $scope.refresh_datapoint(example_to_show_id);
             }
         });
       };
@@ -1332,6 +1360,13 @@ angular.module('newapp').controller('FactChecker', function ($scope, $http) {
     $scope.src_unlocked = false;
     $scope.facteval_lastts = {};
     $scope.facteval_promisechain = {};
+    $scope.facteval_inflight = {};     // line code -> id of the check running on the server for it
+
+    window.addEventListener("pagehide", function () {
+        const form = new FormData();
+        form.append("bundle", JSON.stringify({"session_id": $scope.session_id}));
+        navigator.sendBeacon("./cancel", form);
+    });
 
     // hack to fix the problem of toast blocking clicks to other ui elements [https://github.com/twbs/bootstrap/issues/28752]
     $(".toast").addClass("hide");
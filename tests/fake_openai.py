@@ -0,0 +1,155 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def get_claim(prompt):
+    # the claim in a fact-checking prompt of a decoder-only model (see factcheckers.utils.make_prompt)
+    return prompt.split("CLAIM: ")[-1].replace(" EVIDENCE:", "")
+
+
+class Budget(object):
+    # refills continuously at a rate per minute up to one minute's worth, which is how OpenAI enforces its rate limits
+    def __init__(self, per_minute):
+        self.per_minute = per_minute
+        self.available = float(per_minute)
+        self.last_refill = time.monotonic()
+
+    def take(self, amount):
+        if self.per_minute==0:
+            return True
+        now = time.monotonic()
+        self.available = min(self.per_minute, self.available+(now-self.last_refill)*self.per_minute/60.0)
+        self.last_refill = now
+        # a little slack for the clocks of the client and the server
+        if self.available+0.01*self.per_minute<amount:
+            return False
+        self.available -= amount
+        return True
+
+
+class FakeOpenAIServer(object):
+    '''
+    Local stand-in for an OpenAI-compatible server (/v1/models, /v1/completions and /v1/chat/completions), running in a
+    thread.
+
+    Completions answer with "SENT0 REVISION: <claim>" after `delay` seconds (a number, or a function of the prompt), cut
+    at the stop strings of the request, and with made-up token logprobs if asked for. Chat completions answer with a
+    fixed sentence. The server keeps the requests it got, and the largest number of them it had in flight at the same time.
+
+    Chat completions are subject to rate limits: beyond rpm requests or tpm tokens (max_tokens of the requests) per
+    minute, or for the first num_rejected requests, the server responds with a 429 asking to retry after retry_after
+    seconds.
+    '''
+    model_name = "fake-model"
+
+    def __init__(self, delay=0.0, token_logprobs=(-0.1, -0.5, -0.2), rpm=0, tpm=0, num_rejected=0, retry_after=1):
+        self.delay = delay
+        self.token_logprobs = list(token_logprobs)
+        self.lock = threading.Lock()
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+        self.request_budget = Budget(rpm)
+        self.token_budget = Budget(tpm)
+        self.num_rejected = num_rejected
+        self.retry_after = retry_after
+        self.num_rate_limited = 0
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.rstrip("/").endswith("/models"):
+                    self.send_json(200, {"object": "list", "data": [{"id": server.model_name, "object": "model", "created": 0, "owned_by": "test"}]})
+                else:
+                    self.send_json(404, {"error": {"message": "not found"}})
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                with server.lock:
+                    server.requests.append(body)
+                    server.in_flight += 1
+                    server.max_in_flight = max(server.max_in_flight, server.in_flight)
+                try:
+                    status, headers, output = server.respond(self.path, body)
+                finally:
+                    with server.lock:
+                        server.in_flight -= 1
+                try:
+                    self.send_json(status, output, headers)
+                except (BrokenPipeError, ConnectionResetError):
+                    # the client went away, e.g. a cancelled request
+                    pass
+
+            def send_json(self, status, output, headers=None):
+                data = json.dumps(output).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for (name, value) in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.base_url = f"http://127.0.0.1:{self.httpd.server_address[1]}/v1"
+
+    def get_delay(self, prompt):
+        return self.delay(prompt) if callable(self.delay) else self.delay
+
+    def respond(self, path, body):
+        '''
+        :return: A tuple of the status, extra headers and json body of the response.
+        '''
+        if path.rstrip("/").endswith("/chat/completions"):
+            return self.respond_chat(body)
+        if not path.rstrip("/").endswith("/completions"):
+            return 404, {}, {"error": {"message": "not found"}}
+
+        time.sleep(self.get_delay(body["prompt"]))
+        text = f" SENT0 REVISION: {get_claim(body['prompt'])}"
+        for stop in body.get("stop") or []:
+            text = text.split(stop)[0]
+
+        logprobs = None
+        if body.get("logprobs") is not None:
+            logprobs = {"tokens": [f"t{j}" for j in range(len(self.token_logprobs))],
+                        "token_logprobs": self.token_logprobs,
+                        "top_logprobs": None,
+                        "text_offset": list(range(len(self.token_logprobs)))}
+        return 200, {}, {"id": "cmpl-fake", "object": "text_completion", "created": 0, "model": body["model"],
+                         "choices": [{"index": 0, "text": text, "logprobs": logprobs, "finish_reason": "stop"}],
+                         "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2}}
+
+    def respond_chat(self, body):
+        with self.lock:
+            rejected = self.num_rejected>0
+            if rejected:
+                self.num_rejected -= 1
+            elif not self.request_budget.take(1):
+                rejected = True
+            elif not self.token_budget.take(body.get("max_tokens") or 0):
+                rejected = True
+            if rejected:
+                self.num_rate_limited += 1
+                return 429, {"retry-after": str(self.retry_after)}, {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}}
+
+        time.sleep(self.get_delay(body["messages"][-1]["content"]))
+        return 200, {}, {"id": "chatcmpl-fake", "object": "chat.completion", "created": 0, "model": body["model"],
+                         "choices": [{"index": 0, "message": {"role": "assistant", "content": "The patient was discharged on Friday."}, "finish_reason": "stop"}],
+                         "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2}}
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,86 @@
+import gzip
+import json
+import os
+
+from genaudit.annotation_store import AnnotationStore, CATALOG_NAME, SEGMENTS_DIR
+
+
+def make_record(j):
+    return {"id": f"ex{j}", "input_lines": [f"Input {j}."], "output_lines": [f"Output {j}."]}
+
+
+def fill(store, num):
+    for j in range(num):
+        assert store.append(make_record(j))
+
+
+def test_append_and_get(tmp_path):
+    store = AnnotationStore(str(tmp_path))
+    fill(store, 3)
+    assert not store.append({"id": "ex1", "input_lines": [], "output_lines": []})
+    assert store.get("ex1")==make_record(1)
+    assert "ex2" in store and "ex3" not in store
+    assert [x["id"] for x in store.iter_records()]==["ex0", "ex1", "ex2"]
+    # every segment stays a valid .jsonl.gz file
+    for name in os.listdir(tmp_path/SEGMENTS_DIR):
+        with gzip.open(tmp_path/SEGMENTS_DIR/name, "rt") as f:
+            assert [json.loads(x)["id"] for x in f]==["ex0", "ex1", "ex2"]
+
+
+def test_other_writers_are_seen(tmp_path):
+    store = AnnotationStore(str(tmp_path))
+    other = AnnotationStore(str(tmp_path))
+    fill(store, 2)
+    assert sorted(other.ids())==["ex0", "ex1"]
+    assert not other.append(make_record(0))
+
+
+def test_fragment_of_a_crashed_writer_is_cut_off(tmp_path):
+    store = AnnotationStore(str(tmp_path))
+    fill(store, 2)
+    with open(tmp_path/CATALOG_NAME, "ab") as f:
+        f.write(b'["ex9", "segment-000000.jsonl.gz", 12')
+
+    # readers wait for the rest of the line, and the next writer removes it
+    fresh = AnnotationStore(str(tmp_path))
+    assert sorted(fresh.ids())==["ex0", "ex1"]
+    assert fresh.append(make_record(2))
+    assert [x["id"] for x in AnnotationStore(str(tmp_path)).iter_records()]==["ex0", "ex1", "ex2"]
+    with open(tmp_path/CATALOG_NAME, "rb") as f:
+        assert all(len(json.loads(line))==5 for line in f)
+
+
+def test_damaged_catalog_line_is_skipped(tmp_path):
+    store = AnnotationStore(str(tmp_path))
+    fill(store, 1)
+    with open(tmp_path/CATALOG_NAME, "ab") as f:
+        f.write(b'["ex9", "segm\n')
+    assert AnnotationStore(str(tmp_path)).append(make_record(1))
+    assert sorted(AnnotationStore(str(tmp_path)).ids())==["ex0", "ex1"]
+
+
+def test_compaction_keeps_records_and_their_order(tmp_path):
+    store = AnnotationStore(str(tmp_path))
+    reader = AnnotationStore(str(tmp_path))
+    fill(store, 10)
+    assert reader.get("ex3")==make_record(3)
+
+    store.compact(records_per_member=4)
+    segments = os.listdir(tmp_path/SEGMENTS_DIR)
+    assert len(segments)==1 and segments[0].startswith("compact-")
+    # the reader still holds the entries of the old catalog, whose segments are gone now
+    assert reader.get("ex7")==make_record(7)
+    assert [x["id"] for x in reader.iter_records()]==[f"ex{j}" for j in range(10)]
+
+    # appends after a compaction go to new segments, which sort after the compacted ones
+    assert store.append(make_record(10))
+    assert [x["id"] for x in reader.iter_records()]==[f"ex{j}" for j in range(11)]
+
+
+def test_export_survives_a_compaction(tmp_path):
+    store = AnnotationStore(str(tmp_path), max_segment_bytes=200)
+    fill(store, 6)
+    records = store.iter_records()
+    assert [next(records)["id"], next(records)["id"]]==["ex0", "ex1"]
+    AnnotationStore(str(tmp_path)).compact(records_per_member=2)
+    assert [x["id"] for x in records]==[f"ex{j}" for j in range(2, 6)]
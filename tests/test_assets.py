@@ -0,0 +1,67 @@
+import gzip
+
+import pytest
+
+from genaudit.assets import AssetCache
+
+
+class FakeAsset(object):
+    def __init__(self, encodings):
+        self.variants = {x: (b"", f'"{x}"') for x in ["identity"]+encodings}
+
+
+class FakeRequest(object):
+    def __init__(self, **headers):
+        self.headers = {k.replace("_", "-"): v for (k, v) in headers.items()}
+
+
+@pytest.fixture
+def cache(tmp_path):
+    (tmp_path/"lib").mkdir()
+    (tmp_path/"example.js").write_text("function f() { return 1; }\n"*200)
+    (tmp_path/"lib"/"jquery-3.3.1.min.js").write_text("var x = 1;\n"*200)
+    (tmp_path/"logo.png").write_bytes(b"\x89PNG"+bytes(range(256)))
+    return AssetCache(str(tmp_path))
+
+
+@pytest.mark.parametrize("accept_encoding,expected", [
+    ("", "identity"),
+    ("gzip", "gzip"),
+    ("gzip, br", "br"),
+    ("br;q=0.5, gzip", "gzip"),
+    ("br;q=0, gzip", "gzip"),
+    ("br;q=0, gzip;q=0", "identity"),
+    ("*", "br"),
+    ("*;q=0.5, br;q=0", "gzip"),
+    ("gzip;q=bad", "identity"),
+    (" GZIP ; q=0.8 ", "gzip"),
+])
+def test_pick_encoding(accept_encoding, expected):
+    assert AssetCache.pick_encoding(FakeAsset(["gzip", "br"]), accept_encoding)==expected
+
+
+def test_pick_encoding_only_offers_existing_variants():
+    assert AssetCache.pick_encoding(FakeAsset(["gzip"]), "br, gzip;q=0.5")=="gzip"
+    assert AssetCache.pick_encoding(FakeAsset([]), "br, gzip")=="identity"
+
+
+def test_cache_control_by_name(cache):
+    assert cache.get_cache_control("lib/jquery-3.3.1.min.js")=="public, max-age=31536000, immutable"
+    assert cache.get_cache_control("example.js")=="no-cache"
+    assert cache.get_cache_control("lib/codemirror.js")=="no-cache"
+
+
+def test_serve_compressed_and_revalidated(cache):
+    response = cache.serve("example.js", FakeRequest(Accept_Encoding="gzip"))
+    assert response.status_code==200
+    assert response.headers["Content-Encoding"]=="gzip"
+    assert gzip.decompress(response.body)==b"function f() { return 1; }\n"*200
+
+    response = cache.serve("example.js", FakeRequest(Accept_Encoding="gzip", If_None_Match=response.headers["ETag"]))
+    assert response.status_code==304
+
+
+def test_images_are_not_compressed(cache):
+    response = cache.serve("logo.png", FakeRequest(Accept_Encoding="gzip, br"))
+    assert "Content-Encoding" not in response.headers
+    assert response.headers["Cache-Control"]=="no-cache"
@@ -0,0 +1,65 @@
+import math
+import time
+
+import pytest
+
+from fake_openai import FakeOpenAIServer
+
+# the factcheckers package loads the in-process backends too, which need torch
+oai_predictor = pytest.importorskip("genaudit.factcheckers.oai_predictor")
+
+
+def make_dp(claim):
+    return {"input_lines": ["The patient was admitted on Monday.", "She was discharged on Friday."],
+            "before_summary_sent": claim,
+            "prev_summ_lines": [],
+            "after_summary_sent": "dummmy",
+            "id": "xxxxx",
+            "evidence_labels": [0]}
+
+
+def test_predict_without_model_name_uses_first_served_model():
+    with FakeOpenAIServer() as server:
+        predictor = oai_predictor.OpenaiCompatPredictor(server.base_url)
+        assert predictor.model_name==FakeOpenAIServer.model_name
+        assert predictor.predict(make_dp("Admitted on Monday.")) == "EVIDENCE: SENT0 REVISION: Admitted on Monday."
+
+
+def test_predict_many_keeps_order_and_respects_max_concurrency():
+    claims = [f"Claim number {j}." for j in range(10)]
+    # later claims are answered sooner, so that the responses arrive out of order
+    delay = lambda prompt: 0.05*(10-int(prompt.split("Claim number ")[-1].split(".")[0]))
+    with FakeOpenAIServer(delay=delay) as server:
+        predictor = oai_predictor.OpenaiCompatPredictor(server.base_url, max_concurrency=3)
+        outputs = predictor.predict_many([make_dp(x) for x in claims])
+        assert outputs==[f"EVIDENCE: SENT0 REVISION: {x}" for x in claims]
+        assert server.max_in_flight==3
+
+
+def test_evidence_only_stops_at_revision():
+    with FakeOpenAIServer() as server:
+        predictor = oai_predictor.OpenaiCompatPredictor(server.base_url)
+        output = predictor.predict(make_dp("Admitted on Monday."), evidence_only=True)
+        assert server.requests[-1]["stop"]==["REVISION:"]
+        assert output.strip()=="EVIDENCE: SENT0"
+
+
+def test_confidence_is_probability_of_least_likely_token():
+    with FakeOpenAIServer(token_logprobs=(-0.1, -0.7, -0.3)) as server:
+        predictor = oai_predictor.OpenaiCompatPredictor(server.base_url)
+        output, confidence = predictor.predict(make_dp("Admitted on Monday."), with_confidence=True)
+        assert server.requests[-1]["logprobs"]==1
+        assert output=="EVIDENCE: SENT0 REVISION: Admitted on Monday."
+        assert confidence==pytest.approx(math.exp(-0.7))
+
+
+def test_cancellation_stops_waiting_for_the_server():
+    with FakeOpenAIServer(delay=5.0) as server:
+        predictor = oai_predictor.OpenaiCompatPredictor(server.base_url)
+        start_time = time.time()
+        should_stop = lambda: time.time()-start_time>0.2
+        assert predictor.predict(make_dp("Admitted on Monday."), should_stop=should_stop) is None
+
+        start_time = time.time()
+        assert predictor.predict_many([make_dp("a."), make_dp("b.")], should_stop=should_stop)==[None, None]
+        assert time.time()-start_time<2.0
@@ -0,0 +1,82 @@
+import time
+
+import pytest
+
+from fake_openai import FakeOpenAIServer
+
+# the module loads the in-process QA backend too, which needs torch
+qa_models = pytest.importorskip("genaudit.qa_models")
+
+MODEL_NAME = "gpt-3.5-turbo-16k-0613"
+
+
+def make_predictor(server, **kwargs):
+    return qa_models.OpenaiPredictor(MODEL_NAME, base_url=server.base_url, **kwargs)
+
+
+def make_dp(j=0):
+    return qa_models.make_prompt({"document": "The patient was admitted on Monday. She was discharged on Friday.",
+                                  "question": f"When was the patient discharged? ({j})"})
+
+
+class FakeEncoding(object):
+    def encode(self, text):
+        return text.split()
+
+
+@pytest.fixture(autouse=True)
+def api_key(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "EMPTY")
+
+
+@pytest.fixture(autouse=True)
+def offline_tokenizer(monkeypatch):
+    # tiktoken downloads its encodings on first use, which fails without network access. prompt lengths only need to be
+    # roughly right here.
+    monkeypatch.setattr(qa_models.tiktoken, "encoding_for_model", lambda model_name: FakeEncoding())
+
+
+def test_requests_per_minute_budget_is_honored():
+    # 60 requests fit in the budget right away, the 3 after them go out one per second
+    with FakeOpenAIServer(rpm=60) as server:
+        predictor = make_predictor(server, rpm=60)
+        start_time = time.time()
+        outputs = predictor.predict_many([make_dp(j) for j in range(63)], max_decode_len=10)
+        assert all(x["success"] for x in outputs)
+        assert time.time()-start_time>=2.5
+        assert server.num_rate_limited==0
+
+
+def test_tokens_per_minute_budget_is_honored():
+    # the second request only fits in the budget once about 2 seconds worth of tokens have been refilled
+    with FakeOpenAIServer(tpm=60000) as server:
+        predictor = make_predictor(server, tpm=60000)
+        start_time = time.time()
+        outputs = predictor.predict_many([make_dp(0), make_dp(1)], max_decode_len=31000)
+        assert all(x["success"] for x in outputs)
+        assert time.time()-start_time>=1.8
+        assert server.num_rate_limited==0
+
+
+def test_retry_after_is_honored_and_reported():
+    with FakeOpenAIServer(num_rejected=1, retry_after=1) as server:
+        predictor = make_predictor(server)
+        start_time = time.time()
+        output = predictor.predict(make_dp(), max_decode_len=10)
+        assert output["success"]
+        assert time.time()-start_time>=1.0
+        assert server.num_rate_limited==1
+
+        stats = predictor.get_stats()
+        assert stats["requests"]==2
+        assert stats["rate_limited"]==1
+        assert stats["rate_limited_frac"]==pytest.approx(0.5)
+
+
+def test_predict_can_be_cancelled():
+    with FakeOpenAIServer(delay=5.0) as server:
+        predictor = make_predictor(server)
+        start_time = time.time()
+        output = predictor.predict(make_dp(), max_decode_len=10, should_stop=lambda: time.time()-start_time>0.2)
+        assert output.get("cancelled", False)
+        assert time.time()-start_time<2.0
@@ -0,0 +1,234 @@
+import queue
+import threading
+
+import pytest
+
+from genaudit.scheduler import DeviceScheduler, get_fingerprint, FACTCHECK, INTERACTIVE, BULK, BACKGROUND
+
+
+def make_scheduler(num_workers=1, devices=None, **kwargs):
+    '''
+    :return: The scheduler (not started yet), the queue results come back on, and an (input queue, cancel event) pair for each worker.
+    '''
+    scheduler = DeviceScheduler(**kwargs)
+    res_queue = queue.Queue()
+    workers = []
+    for j in range(num_workers):
+        in_queue = queue.Queue()
+        cancel_event = threading.Event()
+        device = devices[j] if devices is not None else 0
+        scheduler.add_worker(kind=FACTCHECK, device=device, in_queue=in_queue, res_queue=res_queue, cancel_event=cancel_event)
+        workers.append((in_queue, cancel_event))
+    return scheduler, res_queue, workers
+
+
+def run_all(scheduler, in_queue):
+    # plays a single worker: takes the jobs one by one and hands their results back, returning their payloads in order
+    payloads = []
+    while True:
+        try:
+            job = in_queue.get(timeout=0.3)
+        except queue.Empty:
+            return payloads
+        payloads.append(job["payload"])
+        scheduler.release(job["key"])
+
+
+def submit(scheduler, key, payload=None, fingerprint=None, **kwargs):
+    payload = payload if payload is not None else key
+    scheduler.submit(kind=FACTCHECK, key=key, payload=payload, fingerprint=fingerprint, **kwargs)
+
+
+def test_round_robin_between_clients():
+    scheduler, _, [(in_queue, _)] = make_scheduler()
+    for key in ["a1", "a2", "a3"]:
+        submit(scheduler, key, client="a")
+    submit(scheduler, "b1", client="b")
+    submit(scheduler, "c1", client="c")
+    scheduler.start()
+    assert run_all(scheduler, in_queue)==["a1", "b1", "c1", "a2", "a3"]
+
+
+def test_priority_classes_are_served_in_order():
+    scheduler, _, [(in_queue, _)] = make_scheduler()
+    submit(scheduler, "background", priority=BACKGROUND)
+    submit(scheduler, "bulk", priority=BULK)
+    submit(scheduler, "interactive", priority=INTERACTIVE)
+    scheduler.start()
+    assert run_all(scheduler, in_queue)==["interactive", "bulk", "background"]
+
+
+def test_device_limit():
+    scheduler, _, workers = make_scheduler(num_workers=2, device_limits={0: 1})
+    submit(scheduler, "x")
+    submit(scheduler, "y")
+    scheduler.start()
+
+    dispatched = []
+    for (in_queue, _) in workers:
+        try:
+            dispatched.append(in_queue.get(timeout=0.3))
+        except queue.Empty:
+            pass
+    # both workers are idle, but only one job may run on the device at a time
+    assert len(dispatched)==1
+    assert scheduler.get_stats()["devices"]["0"]=={"running": 1, "limit": 1}
+
+    scheduler.release(dispatched[0]["key"])
+    dispatched = []
+    for (in_queue, _) in workers:
+        try:
+            dispatched.append(in_queue.get(timeout=0.3))
+        except queue.Empty:
+            pass
+    assert [x["payload"] for x in dispatched]==["y"]
+
+
+def test_separate_devices_run_in_parallel():
+    scheduler, _, workers = make_scheduler(num_workers=2, devices=[0, 1], default_limit=1)
+    submit(scheduler, "x")
+    submit(scheduler, "y")
+    scheduler.start()
+    assert sorted(q.get(timeout=1)["payload"] for (q, _) in workers)==["x", "y"]
+
+
+def test_identical_requests_share_one_job():
+    scheduler, _, [(in_queue, _)] = make_scheduler()
+    fingerprint = get_fingerprint(FACTCHECK, {"claim": "x"})
+    submit(scheduler, "k1", fingerprint=fingerprint)
+    submit(scheduler, "k2", fingerprint=fingerprint)
+    scheduler.start()
+
+    job = in_queue.get(timeout=1)
+    assert scheduler.get_waiters(job["key"])==["k1", "k2"]
+    assert scheduler.release(job["key"])==["k1", "k2"]
+    assert scheduler.get_stats()["coalesced"]=={FACTCHECK: 1}
+    assert in_queue.empty()
+
+
+def test_cancelling_one_of_several_waiters_detaches_it():
+    scheduler, res_queue, [(in_queue, cancel_event)] = make_scheduler()
+    submit(scheduler, "k1", fingerprint="f")
+    submit(scheduler, "k2", fingerprint="f")
+    scheduler.start()
+    job = in_queue.get(timeout=1)
+
+    assert scheduler.cancel("k2")
+    out = res_queue.get(timeout=1)
+    assert out["waiters"]==["k2"] and out["payload"]["cancelled"]
+    # the job keeps running for the other request
+    assert not cancel_event.is_set()
+    assert scheduler.release(job["key"])==["k1"]
+
+
+def test_cancelling_a_queued_job_drops_it():
+    scheduler, res_queue, [(in_queue, _)] = make_scheduler()
+    submit(scheduler, "k1")
+    assert scheduler.cancel("k1")
+    out = res_queue.get(timeout=1)
+    assert out["waiters"]==["k1"] and out["payload"]["cancelled"]
+
+    scheduler.start()
+    assert run_all(scheduler, in_queue)==[]
+    assert not scheduler.cancel("k1")
+
+
+def test_cancelling_a_running_job_signals_its_worker():
+    scheduler, _, [(in_queue, cancel_event)] = make_scheduler()
+    submit(scheduler, "k1", fingerprint="f")
+    scheduler.start()
+    job = in_queue.get(timeout=1)
+
+    assert scheduler.cancel("k1")
+    assert cancel_event.is_set()
+    # a new identical request must not attach to the job being stopped
+    submit(scheduler, "k2", fingerprint="f")
+    assert scheduler.get_waiters(job["key"])==["k1"]
+
+    assert scheduler.release(job["key"])==["k1"]
+    next_job = in_queue.get(timeout=1)
+    assert next_job["key"]!=job["key"]
+    # the cancel signal of the previous job is cleared before the next one is handed out
+    assert not cancel_event.is_set()
+
+
+def test_cancel_between_dispatch_and_worker_read_is_kept():
+    scheduler, _, [(in_queue, cancel_event)] = make_scheduler()
+    submit(scheduler, "k1")
+    scheduler.start()
+    while scheduler.get_stats()["devices"]["0"]["running"]==0:
+        pass
+    scheduler.cancel("k1")
+    in_queue.get(timeout=1)
+    assert cancel_event.is_set()
+
+
+def test_newer_request_for_the_same_slot_supersedes_the_older_one():
+    scheduler, res_queue, [(in_queue, _)] = make_scheduler()
+    submit(scheduler, "old", session="s", slot="line1")
+    submit(scheduler, "new", session="s", slot="line1")
+    out = res_queue.get(timeout=1)
+    assert out["waiters"]==["old"] and out["payload"]["cancelled"]
+
+    scheduler.start()
+    assert run_all(scheduler, in_queue)==["new"]
+
+
+def test_unchanged_request_for_the_same_slot_keeps_the_job():
+    scheduler, res_queue, [(in_queue, cancel_event)] = make_scheduler()
+    submit(scheduler, "old1", session="s", slot="line1", fingerprint="f")
+    submit(scheduler, "old2", session="s", slot="line1", fingerprint="f")
+    out = res_queue.get(timeout=1)
+    assert out["waiters"]==["old1"] and out["payload"]["cancelled"]
+
+    scheduler.start()
+    job = in_queue.get(timeout=1)
+    submit(scheduler, "new", session="s", slot="line1", fingerprint="f")
+    assert res_queue.get(timeout=1)["waiters"]==["old2"]
+    # the running job is not stopped, the new request just waits for its result
+    assert not cancel_event.is_set()
+    assert scheduler.release(job["key"])==["new"]
+    assert run_all(scheduler, in_queue)==[]
+
+
+def test_cancel_session():
+    scheduler, _, [(in_queue, _)] = make_scheduler()
+    submit(scheduler, "k1", session="s", slot="line1")
+    submit(scheduler, "k2", session="s", slot="line2")
+    submit(scheduler, "k3", session="other", slot="line1")
+    assert scheduler.cancel_session("s")==2
+    scheduler.start()
+    assert run_all(scheduler, in_queue)==["k3"]
+
+
+def test_queued_background_job_moves_up_when_an_interactive_request_attaches():
+    scheduler, _, [(in_queue, _)] = make_scheduler()
+    submit(scheduler, "bulk", client="b", priority=BULK)
+    submit(scheduler, "preaudit", payload="shared", client="preaudit", priority=BACKGROUND, fingerprint="f")
+    submit(scheduler, "user", client="u", priority=INTERACTIVE, fingerprint="f")
+
+    stats = scheduler.get_stats()
+    assert stats["interactive_factcheck"]["queued"]==1
+    assert stats["background_factcheck"]["queued"]==0
+    scheduler.start()
+    assert run_all(scheduler, in_queue)==["shared", "bulk"]
+
+
+def test_duplicate_pending_key_is_rejected():
+    scheduler, _, _ = make_scheduler()
+    submit(scheduler, "k1")
+    assert scheduler.has_key("k1")
+    with pytest.raises(ValueError):
+        submit(scheduler, "k1", payload="other")
+
+
+def test_is_idle():
+    scheduler, _, [(in_queue, _)] = make_scheduler()
+    assert scheduler.is_idle(FACTCHECK)
+    submit(scheduler, "k1")
+    assert not scheduler.is_idle(FACTCHECK)
+    scheduler.start()
+    job = in_queue.get(timeout=1)
+    assert not scheduler.is_idle(FACTCHECK)
+    scheduler.release(job["key"])
+    assert scheduler.is_idle(FACTCHECK)
@@ -0,0 +1,94 @@
+import json
+import re
+
+from genaudit.streaming import IncrementalSentencizer, format_sse
+
+
+class Span(object):
+    def __init__(self, text, start_char):
+        self.text = text
+        self.start_char = start_char
+
+    def __str__(self):
+        return self.text
+
+
+class FakeNlp(object):
+    '''
+    Stands in for a spaCy pipeline: a sentence ends after ".", "?" or "!" once followed by a space. Keeps the texts it
+    was called on.
+    '''
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, text):
+        self.calls.append(text)
+        spans = []
+        start = 0
+        for m in re.finditer(r"[.?!]+(?= )", text):
+            spans.append(Span(text[start:m.end()], start))
+            start = m.end()
+        if start<len(text):
+            spans.append(Span(text[start:], start))
+        return Doc(spans)
+
+
+class Doc(object):
+    def __init__(self, sents):
+        self.sents = sents
+
+
+def feed_all(sentencizer, chunks):
+    reported = []
+    for chunk in chunks:
+        reported.append(sentencizer.feed(chunk))
+    reported.append(sentencizer.finish())
+    return reported
+
+
+def test_sentence_is_reported_once_the_next_one_starts():
+    sentencizer = IncrementalSentencizer(FakeNlp())
+    reported = feed_all(sentencizer, ["The patient", " was admitted.", " She", " was discharged", " on Friday."])
+    assert reported==[[], [], ["The patient was admitted."], [], [], ["She was discharged on Friday."]]
+    assert sentencizer.sents==["The patient was admitted.", "She was discharged on Friday."]
+
+
+def test_chunking_does_not_change_the_sentences():
+    text = "First one. Second one? Third one! And the last one"
+    expected = ["First one.", "Second one?", "Third one!", "And the last one"]
+    for size in [1, 2, 3, 7, len(text)]:
+        sentencizer = IncrementalSentencizer(FakeNlp())
+        feed_all(sentencizer, [text[j:j+size] for j in range(0, len(text), size)])
+        assert sentencizer.sents==expected
+
+
+def test_newlines_are_treated_as_spaces():
+    sentencizer = IncrementalSentencizer(FakeNlp())
+    feed_all(sentencizer, ["One.\n", "Two."])
+    assert sentencizer.sents==["One.", "Two."]
+
+
+def test_only_the_tail_is_reparsed_and_only_after_a_possible_boundary():
+    nlp = FakeNlp()
+    sentencizer = IncrementalSentencizer(nlp)
+    sentencizer.feed("First one.")
+    sentencizer.feed(" Second")
+    num_calls = len(nlp.calls)
+    # no chunk since the last boundary could end a sentence
+    sentencizer.feed(" one")
+    sentencizer.feed(" goes on")
+    assert len(nlp.calls)==num_calls
+    sentencizer.feed(". Third")
+    assert nlp.calls[-1]==" Second one goes on. Third"
+
+
+def test_whitespace_only_text_gives_no_sentences():
+    sentencizer = IncrementalSentencizer(FakeNlp())
+    assert feed_all(sentencizer, ["  ", "\n"])==[[], [], []]
+    assert sentencizer.sents==[]
+
+
+def test_format_sse():
+    out = format_sse("sentence", {"text": "Größe"})
+    assert out.startswith("event: sentence\ndata: ") and out.endswith("\n\n")
+    assert json.loads(out.split("data: ", 1)[1])=={"text": "Größe"}